@@ -1,73 +1,455 @@
+import argparse
+import os
+import time
 # from utils.data_utils import get_valor_empreendimento_total
-from processors.file_processor import process_excel_folder, process_composicoes_folder
-from processors.excel_generator import create_merged_excel_files
-from utils.sharepoint import upload_excel_files_to_sharepoint
+from utils.logging_config import configure_logging
+from utils.run_history import (
+    start_run, finish_run, timed_stage, record_upload, record_stem_rows, load_run_history,
+    compare_with_baseline, DEFAULT_BASELINE_RUNS, DEFAULT_REGRESSION_THRESHOLD
+)
 
+# Heavy modules (pandas, numpy, requests) are imported inside the stage that needs them,
+# so e.g. `python main.py upload` does not pay for pandas at startup.
 
-def main():
-    print("="*60)
-    print("INTEGRATED EXCEL AND COMPOSICOES PROCESSOR WITH GROUPING")
-    print("="*60)
-    
-    # valor_empreendimento_total = get_valor_empreendimento_total()
-    
-    print(f"\n{'='*50}")
-    print("PROCESSING EXCEL FOLDER")
-    print(f"{'='*50}")
-    excel_data = process_excel_folder()
-    
-    print(f"\n{'='*50}")
-    print("PROCESSING COMPOSICOES FOLDER")
-    print(f"{'='*50}")
-    composicoes_data = process_composicoes_folder()
-    
-    create_merged_excel_files(
-        excel_data,
-        composicoes_data,
-        #valor_empreendimento_total,
-        output_folder="output"
-    )
-    
-    print(f"\n{'='*60}")
-    print("PROCESSING COMPLETE WITH GROUPING LOGIC!")
-    print(f"💾 Output saved to folder: 'output/'")
-    print(f"{'='*60}")
-    print(f"\n{'='*50}")
-    print("UPLOADING TO SHAREPOINT")
-    print(f"{'='*50}")
-    
+INGEST_ARTIFACT = "ingest.json"
+GROUPED_ARTIFACT = "grouped.json"
+PATTERN_STATS_ARTIFACT = "pattern_stats.json"
+GROUP_CACHE_ARTIFACT = "group_cache.json"
+RUN_HISTORY_ARTIFACT = "run_history.jsonl"
+# Same default as processors.grouping_logic.MAX_EXPANDED_ROWS, kept here so startup does not import pandas
+DEFAULT_MAX_EXPANDED_ROWS = 10000
+
+
+def print_section(title, width=50):
+    print(f"\n{'='*width}")
+    print(title)
+    print(f"{'='*width}")
+
+
+def load_group_cache(args):
+    if os.getenv('GROUP_CACHE') != '1':
+        return None
+
+    from utils.artifacts import load_artifact
     try:
-        upload_results = upload_excel_files_to_sharepoint("output")
-        
+        return load_artifact(os.path.join(args.artifacts_dir, GROUP_CACHE_ARTIFACT))
+    except FileNotFoundError:
+        return {}
+
+
+def save_group_cache(args, group_cache):
+    if group_cache is None:
+        return
+
+    from utils.artifacts import save_artifact
+    artifact_path = os.path.join(args.artifacts_dir, GROUP_CACHE_ARTIFACT)
+    save_artifact(artifact_path, group_cache)
+    print(f"♻️  Group cache saved to '{artifact_path}'")
+
+
+def run_ingest(args):
+    from processors.file_processor import process_excel_folder, process_composicoes_folder
+    from utils.artifacts import save_artifact
+
+    print_section("PROCESSING EXCEL FOLDER")
+    excel_data = process_excel_folder(args.excel_folder, memory_report=args.memory_report,
+                                      processes=args.ingest_processes, prefetch=args.prefetch_workbooks,
+                                      sheet_processes=args.sheet_processes)
+
+    print_section("PROCESSING COMPOSICOES FOLDER")
+    composicoes_data = process_composicoes_folder(args.composicoes_folder)
+
+    artifact_path = os.path.join(args.artifacts_dir, INGEST_ARTIFACT)
+    save_artifact(artifact_path, {"excel_data": excel_data, "composicoes_data": composicoes_data})
+    print(f"💾 Ingested data saved to '{artifact_path}'")
+
+
+def run_group(args):
+    from processors.excel_generator import group_stem_records
+    from utils.artifacts import load_artifact, save_artifact
+
+    ingested = load_artifact(os.path.join(args.artifacts_dir, INGEST_ARTIFACT))
+    excel_data = ingested["excel_data"]
+    composicoes_data = ingested["composicoes_data"]
+
+    print_section("GROUPING FILE RECORDS")
+    group_cache = load_group_cache(args)
+    grouped = {}
+    for file_stem in sorted(set(excel_data) | set(composicoes_data)):
+        original_count, grouped_records = group_stem_records(file_stem, excel_data, composicoes_data,
+                                                             max_expanded_rows=args.max_expanded_rows,
+                                                             group_cache=group_cache)
+        grouped[file_stem] = {"original_records": original_count, "records": grouped_records}
+    save_group_cache(args, group_cache)
+
+    artifact_path = os.path.join(args.artifacts_dir, GROUPED_ARTIFACT)
+    save_artifact(artifact_path, grouped)
+    print(f"💾 Grouped data saved to '{artifact_path}'")
+
+
+def run_export(args):
+    from processors.excel_generator import export_stem_records
+    from utils.artifacts import load_artifact
+
+    grouped = load_artifact(os.path.join(args.artifacts_dir, GROUPED_ARTIFACT))
+
+    print_section("CREATING MERGED EXCEL FILES")
+    os.makedirs(args.output_folder, exist_ok=True)
+    total_grouped = 0
+    for file_stem, stem_data in grouped.items():
+        record_stem_rows(file_stem, stem_data["original_records"])
+        total_grouped += export_stem_records(file_stem, stem_data["records"], args.output_folder,
+                                             expand_repeats=args.expand_repeats,
+                                             max_expanded_rows=args.max_expanded_rows)
+
+    print(f"\n📊 Total grouped records saved across all files: {total_grouped}")
+
+
+def run_upload(args):
+    from utils.sharepoint import upload_excel_files_to_sharepoint
+
+    print_section("UPLOADING TO SHAREPOINT")
+
+    try:
+        with timed_stage("upload"):
+            upload_results = upload_excel_files_to_sharepoint(args.output_folder)
+        record_upload(upload_results)
+
         if upload_results.get("error"):
             print(f"❌ Upload failed: {upload_results['error']}")
         else:
             successful = len(upload_results.get("successful_uploads", []))
             failed = len(upload_results.get("failed_uploads", []))
             total = upload_results.get("total_files", 0)
-            
+
             print(f"📤 SharePoint Upload Complete!")
             print(f"   Total files processed: {total}")
             print(f"   ✅ Successful uploads: {successful}")
             print(f"   ❌ Failed uploads: {failed}")
-            
+
             if upload_results.get("successful_uploads"):
                 print(f"\n   Successfully uploaded files:")
                 for upload in upload_results["successful_uploads"]:
                     print(f"     • {upload['filename']}")
-            
+
             if upload_results.get("failed_uploads"):
                 print(f"\n   Failed uploads:")
                 for failed in upload_results["failed_uploads"]:
                     print(f"     • {failed['filename']}: {failed.get('error', 'Unknown error')}")
-                    
+
     except Exception as e:
         print(f"❌ Error during SharePoint upload: {e}")
-    
+
+
+def run_all(args):
+    print("="*60)
+    print("INTEGRATED EXCEL AND COMPOSICOES PROCESSOR WITH GROUPING")
+    print("="*60)
+
+    # valor_empreendimento_total = get_valor_empreendimento_total()
+
+    if os.getenv('PIPELINE_MODE') == 'watch':
+        from processors.watcher import watch_folders
+        watch_folders(args.excel_folder, args.composicoes_folder, args.output_folder,
+                      memory_report=args.memory_report, expand_repeats=args.expand_repeats,
+                      max_expanded_rows=args.max_expanded_rows, use_group_cache=os.getenv('GROUP_CACHE') != '0')
+        return
+
+    group_cache = load_group_cache(args)
+
+    if os.getenv('PIPELINE_MODE') == 'per-stem':
+        from processors.stem_pipeline import run_stem_pipeline
+        with timed_stage("per_stem_pipeline"):
+            run_stem_pipeline(args.excel_folder, args.composicoes_folder, args.output_folder,
+                              memory_report=args.memory_report, expand_repeats=args.expand_repeats,
+                              max_expanded_rows=args.max_expanded_rows, group_cache=group_cache)
+    else:
+        from processors.file_processor import process_excel_folder, process_composicoes_folder
+        from processors.excel_generator import create_merged_excel_files
+
+        print_section("PROCESSING EXCEL FOLDER")
+        with timed_stage("ingest_razoes"):
+            excel_data = process_excel_folder(args.excel_folder, memory_report=args.memory_report,
+                                              processes=args.ingest_processes, prefetch=args.prefetch_workbooks,
+                                              sheet_processes=args.sheet_processes)
+
+        print_section("PROCESSING COMPOSICOES FOLDER")
+        with timed_stage("ingest_composicoes"):
+            composicoes_data = process_composicoes_folder(args.composicoes_folder)
+
+        with timed_stage("group_and_export"):
+            create_merged_excel_files(
+                excel_data,
+                composicoes_data,
+                #valor_empreendimento_total,
+                output_folder=args.output_folder,
+                expand_repeats=args.expand_repeats,
+                max_expanded_rows=args.max_expanded_rows,
+                group_cache=group_cache
+            )
+
+    save_group_cache(args, group_cache)
+
+    print(f"\n{'='*60}")
+    print("PROCESSING COMPLETE WITH GROUPING LOGIC!")
+    print(f"💾 Output saved to folder: '{args.output_folder}/'")
+    print(f"{'='*60}")
+
+    run_upload(args)
+
     print(f"\n{'='*60}")
     print("ALL PROCESSING AND UPLOAD COMPLETE!")
     print(f"{'='*60}")
 
 
+def run_enqueue(args):
+    from processors.job_queue import enqueue_stems
+
+    print_section("QUEUEING FILE STEMS")
+    enqueue_stems(args.queue_db, args.excel_folder, args.composicoes_folder, requeue=args.requeue)
+
+
+def run_worker_stage(args):
+    import multiprocessing
+    from processors.job_queue import run_worker, default_worker_id, finished_stem_results
+
+    print_section("PROCESSING QUEUED STEMS")
+    worker_kwargs = {
+        "db_path": args.queue_db,
+        "excel_folder": args.excel_folder,
+        "composicoes_folder": args.composicoes_folder,
+        "output_folder": args.output_folder,
+        "lease_seconds": args.lease_seconds,
+        "memory_report": args.memory_report,
+        "expand_repeats": args.expand_repeats,
+        "max_expanded_rows": args.max_expanded_rows,
+    }
+
+    started = time.time()
+    with timed_stage("worker"):
+        if args.processes <= 1:
+            run_worker(**worker_kwargs)
+            worker_ids = {default_worker_id()}
+        else:
+            workers = [multiprocessing.Process(target=run_worker, kwargs=worker_kwargs)
+                       for _ in range(args.processes)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            worker_ids = {default_worker_id(worker.pid) for worker in workers}
+
+    for stem, result in finished_stem_results(args.queue_db, worker_ids, started).items():
+        record_stem_rows(stem, result["original_records"])
+
+
+def run_queue_status(args):
+    from processors.job_queue import queue_status
+
+    print_section("QUEUE STATUS")
+    for status, count in sorted(queue_status(args.queue_db).items()):
+        print(f"   {status}: {count}")
+
+
+def run_ledger_ingest(args):
+    from processors.ledger_store import ingest_folders_into_ledger
+
+    print_section("STORING PARSED WORKBOOKS IN LEDGER")
+    ingest_folders_into_ledger(args.ledger_db, args.excel_folder, args.composicoes_folder,
+                               memory_report=args.memory_report)
+
+
+def run_ledger_group(args):
+    from processors.ledger_store import group_from_ledger
+
+    group_from_ledger(args.ledger_db, args.output_folder, expand_repeats=args.expand_repeats,
+                      max_expanded_rows=args.max_expanded_rows)
+
+
+def run_ledger_query(args):
+    from processors.ledger_store import query_ledger
+
+    print_section("LEDGER QUERY")
+    rows = query_ledger(args.ledger_db, empresa=args.empresa, nota=args.nota)
+    for row in rows:
+        print(f"   {row['path']} [{row['sheet']}] {row['empresa']} nota {row['nota']}: "
+              f"soma {row['soma']} | {row['complemento'] or ''}{'' if row['valid'] else ' (not grouped)'}")
+    print(f"\n   {len(rows)} line(s) found")
+
+
+def run_perf_report(args):
+    print_section("PERFORMANCE REPORT")
+    history = load_run_history(os.path.join(args.artifacts_dir, RUN_HISTORY_ARTIFACT))
+    latest, report = compare_with_baseline(history, args.baseline_runs, args.threshold)
+    if latest is None:
+        print("   No runs recorded yet")
+        return
+
+    print(f"   Latest run: '{latest['stage']}' at {latest['started_at']} "
+          f"({latest['total_rows']} input rows, {len(latest['rows'])} stem(s))")
+    for entry in report:
+        if entry["baseline"] is None:
+            print(f"   {entry['metric']:<28} {entry['latest']:>12.4f} {entry['unit']:<10} (no baseline yet)")
+            continue
+        change = f"({entry['ratio'] - 1:+.0%})" if entry["ratio"] is not None else ""
+        flag = "❌ REGRESSED" if entry["regressed"] else "✅"
+        print(f"   {entry['metric']:<28} {entry['latest']:>12.4f} {entry['unit']:<10} "
+              f"baseline {entry['baseline']:.4f} {change} {flag}")
+
+    regressed = [entry["metric"] for entry in report if entry["regressed"]]
+    if regressed:
+        print(f"\n⚠ {len(regressed)} metric(s) regressed more than {args.threshold:.0%}: {', '.join(regressed)}")
+        # Non-zero exit so a scheduled job can alert on it
+        raise SystemExit(1)
+
+
+def run_verify(args):
+    from processors.verification import (
+        iter_folder_stems, iter_ledger_stems, iter_generated_stems, verify_stems, PATHS
+    )
+
+    print_section("VERIFYING OPTIMIZED GROUPING AGAINST THE REFERENCE")
+    if args.source == "ledger":
+        stems = iter_ledger_stems(args.ledger_db)
+    elif args.source == "generated":
+        stems = iter_generated_stems(args.stems, args.rows, args.seed)
+    else:
+        stems = iter_folder_stems(args.excel_folder, args.composicoes_folder)
+    summary = verify_stems(stems, tolerance=args.tolerance)
+
+    print(f"\n   {summary['stems']} stem(s) compared with a tolerance of {args.tolerance}")
+    reference_seconds = summary["seconds"]["reference"]
+    for path in PATHS:
+        seconds = summary["seconds"][path]
+        speedup = f" ({reference_seconds / seconds:.2f}x)" if seconds and path != "reference" else ""
+        print(f"   {path:<18} {summary['records'][path]:>8} row(s) {seconds:>10.3f}s{speedup}")
+
+    if not summary["differences"]:
+        print("\n✅ Optimized output matches the reference")
+        return
+
+    for file_stem, paths in summary["differences"].items():
+        for path, differences in paths.items():
+            print(f"\n❌ {file_stem} ({path}): {len(differences)} difference(s)")
+            for difference in differences[:args.max_differences]:
+                field = difference["field"] or "record"
+                print(f"     #{difference['position']} {field}: "
+                      f"reference={difference['reference']!r} optimized={difference['optimized']!r}")
+    raise SystemExit(1)
+
+
+STAGES = {
+    "ingest": (run_ingest, f"Read razões and composições into <artifacts-dir>/{INGEST_ARTIFACT}"),
+    "group": (run_group, f"Group and deduplicate {INGEST_ARTIFACT} into {GROUPED_ARTIFACT}"),
+    "export": (run_export, f"Write one Excel file per stem from {GROUPED_ARTIFACT}"),
+    "upload": (run_upload, "Upload the Excel files in the output folder to SharePoint"),
+    "all": (run_all, "Run the whole pipeline in memory and upload (default)"),
+    "enqueue": (run_enqueue, "Add every file stem to the shared work queue"),
+    "worker": (run_worker_stage, "Claim and process stems from the work queue until it is empty"),
+    "queue-status": (run_queue_status, "Show how many queued stems are pending, leased, done or failed"),
+    "ledger-ingest": (run_ledger_ingest, "Store parsed razões and composições in the ledger, skipping unchanged files"),
+    "ledger-group": (run_ledger_group, "Group and export every stem from the ledger instead of the workbooks"),
+    "ledger-query": (run_ledger_query, "List stored lines by empresa and/or nota"),
+    "verify": (run_verify, "Diff the optimized grouping and deduplication against the reference implementation"),
+    "perf-report": (run_perf_report, f"Compare the latest run in {RUN_HISTORY_ARTIFACT} with the previous ones"),
+}
+
+# Read-only stages do not add a record to the run history
+UNRECORDED_STAGES = {"queue-status", "ledger-query", "perf-report", "verify"}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Excel and composições processor")
+    parser.add_argument("--excel-folder", default="razoes")
+    parser.add_argument("--composicoes-folder", default="composicoes")
+    parser.add_argument("--output-folder", default="output")
+    parser.add_argument("--artifacts-dir", default="artifacts",
+                        help="Where stages store their intermediate JSON artifacts")
+
+    parser.add_argument("--queue-db", default=os.path.join("artifacts", "queue.sqlite3"),
+                        help="SQLite work queue shared by enqueue, worker and queue-status")
+
+    parser.add_argument("--ledger-db", default=os.path.join("artifacts", "ledger.sqlite3"),
+                        help="SQLite store of parsed lines kept across runs")
+
+    subparsers = parser.add_subparsers(dest="stage")
+    stage_parsers = {name: subparsers.add_parser(name, help=help_text) for name, (_, help_text) in STAGES.items()}
+
+    stage_parsers["enqueue"].add_argument("--requeue", action="store_true",
+                                          help="Reset stems that are already done or failed")
+    stage_parsers["worker"].add_argument("--processes", type=int, default=1,
+                                         help="Number of worker processes to start on this host")
+    stage_parsers["worker"].add_argument("--lease-seconds", type=float, default=1800,
+                                         help="How long a claimed stem stays reserved without a heartbeat")
+    stage_parsers["ledger-query"].add_argument("--empresa")
+    stage_parsers["ledger-query"].add_argument("--nota")
+    stage_parsers["verify"].add_argument("--source", choices=["folders", "ledger", "generated"], default="folders",
+                                         help="Read the stems from the input folders, the ledger, or generate them")
+    stage_parsers["verify"].add_argument("--stems", type=int, default=3,
+                                         help="How many stems --source generated makes")
+    stage_parsers["verify"].add_argument("--rows", type=int, default=2000,
+                                         help="Razão lines per generated stem")
+    stage_parsers["verify"].add_argument("--seed", type=int, default=0,
+                                         help="Seed for the generated stems")
+    stage_parsers["verify"].add_argument("--tolerance", type=float, default=0.01,
+                                         help="Largest accepted difference in Valor and Valor_Total")
+    stage_parsers["verify"].add_argument("--max-differences", type=int, default=20,
+                                         help="How many differences to print per stem")
+    stage_parsers["perf-report"].add_argument("--baseline-runs", type=int, default=DEFAULT_BASELINE_RUNS,
+                                              help="How many earlier runs of the same stage form the baseline")
+    stage_parsers["perf-report"].add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                                              help="Flag metrics more than this fraction above the baseline")
+
+    return parser
+
+
+def main(argv=None):
+    configure_logging()
+
+    args = build_parser().parse_args(argv)
+    args.memory_report = os.getenv('MEMORY_REPORT') == '1'
+    args.ingest_processes = int(os.getenv('INGEST_PROCESSES', '1'))
+    args.prefetch_workbooks = int(os.getenv('PREFETCH_WORKBOOKS', '2'))
+    args.sheet_processes = int(os.getenv('SHEET_PROCESSES', '1'))
+    args.expand_repeats = os.getenv('EXPAND_REPEATS') != '0'
+    args.max_expanded_rows = int(os.getenv('MAX_EXPANDED_ROWS', str(DEFAULT_MAX_EXPANDED_ROWS)))
+
+    stats_path = os.path.join(args.artifacts_dir, PATTERN_STATS_ARTIFACT)
+    collect_pattern_stats = os.getenv('PATTERN_STATS') == '1'
+
+    if os.getenv('PATTERN_ORDER') == 'adaptive':
+        from utils.regex_patterns import apply_adaptive_nota_order, get_nota_pattern_order
+        if apply_adaptive_nota_order(stats_path):
+            print(f"🔀 Adaptive nota pattern order: {', '.join(get_nota_pattern_order())}")
+        else:
+            print(f"⚠ No verified adaptive order in '{stats_path}', keeping the fixed nota pattern order")
+
+    if collect_pattern_stats:
+        from utils.pattern_stats import enable_pattern_stats
+        enable_pattern_stats()
+
+    stage = args.stage or "all"
+    record_history = stage not in UNRECORDED_STAGES and os.getenv('RUN_HISTORY') != '0'
+    if record_history:
+        start_run(stage)
+    started = time.perf_counter()
+
+    run_stage, _ = STAGES[stage]
+    run_stage(args)
+
+    if record_history:
+        history_path = os.path.join(args.artifacts_dir, RUN_HISTORY_ARTIFACT)
+        record = finish_run(history_path, time.perf_counter() - started)
+        print(f"⏱️  Run recorded in '{history_path}' ({record['seconds']:.1f}s, {record['total_rows']} input rows)")
+
+    if collect_pattern_stats:
+        from utils.pattern_stats import log_pattern_stats
+        from utils.regex_patterns import save_nota_pattern_stats
+        log_pattern_stats()
+        order, mismatches = save_nota_pattern_stats(stats_path)
+        print(f"📈 Pattern stats saved to '{stats_path}'")
+        print(f"   Adaptive nota order: {', '.join(order)} ({len(mismatches)} mismatches against the fixed order)")
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
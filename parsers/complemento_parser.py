@@ -1,21 +1,64 @@
 import re
 import pandas as pd
 from utils.regex_patterns import extract_nota_from_parsed
+from utils.pattern_stats import run_pattern, record_pattern, pattern_stats_enabled
+
+INITIAL_DOCUMENT_BRANCHES = [
+    r"Pg PGELETR\s+\d+",
+    r"FATURA\s+\d+",
+    r"Ref\. AV DÉB\s+\d+",
+    r"AP/\d+",
+    r"CONTRATO",
+    r"Valor ref\. IRRF s/ NF\s*<\d+>",
+    r"Valor ref\. IRRF s/ NF",
+    r"Valor ref\. NF_REF[\s\-]*\d+",
+    r"ISS retido conf\. NFES[\s\-]*\d+",
+    r"Pis, Cofins e Csll sobre NFES[\s\-]*\d+",
+    r"APÓLICE[\s\-]*\d+",
+]
+INITIAL_DOCUMENT_PATTERN = r"^(" + "|".join(INITIAL_DOCUMENT_BRANCHES) + r")\s*-?"
+
+DOCUMENT_REFERENCE_BRANCHES = [
+    r"NFES[\s\-]*\d+",
+    r"NF_REF[\s\-]*\d+",
+    r"NFELETR[\s\-]*\d+",
+    r"APÓLICE[\s\-]*\d+",
+    r"BOLETO[\s\-]?\d*",
+    r"<\d+>",
+]
+DOCUMENT_REFERENCE_PATTERN = r"(" + "|".join(DOCUMENT_REFERENCE_BRANCHES) + r")"
+
+
+def record_branch_hit(name, branches, match):
+    """Count which alternative of a combined regex produced the match (the first one matching at its start)"""
+    for branch in branches:
+        if re.match(branch, match.string[match.start(1):]):
+            record_pattern(f"{name}:{branch}", True, attempted=False)
+            return
+
+
+def search_with_stats(name, pattern, text, branches=None):
+    if not pattern_stats_enabled():
+        return re.search(pattern, text)
+
+    match = run_pattern(name, lambda value: re.search(pattern, value), text)
+    if match and branches:
+        record_branch_hit(name, branches, match)
+    return match
 
 
 def extract_initial_document_pattern(text):
-    pattern = r"^(Pg PGELETR\s+\d+|FATURA\s+\d+|Ref\. AV DÉB\s+\d+|AP/\d+|CONTRATO|Valor ref\. IRRF s/ NF\s*<\d+>|Valor ref\. IRRF s/ NF|Valor ref\. NF_REF[\s\-]*\d+|ISS retido conf\. NFES[\s\-]*\d+|Pis, Cofins e Csll sobre NFES[\s\-]*\d+|APÓLICE[\s\-]*\d+)\s*-?"
-    match = re.search(pattern, text)
+    match = search_with_stats("initial_document", INITIAL_DOCUMENT_PATTERN, text, INITIAL_DOCUMENT_BRANCHES)
     return match.group(1).strip() if match else None
 
 
 def extract_date_document_pattern(text):
-    match = re.search(r"^(\d{2}/\d{2}/\d{4}\s+\d+)\s*-", text)
+    match = search_with_stats("date_document", r"^(\d{2}/\d{2}/\d{4}\s+\d+)\s*-", text)
     return match.group(1).strip() if match else None
 
 
 def extract_document_reference_pattern(text):
-    match = re.search(r"(NFES[\s\-]*\d+|NF_REF[\s\-]*\d+|NFELETR[\s\-]*\d+|APÓLICE[\s\-]*\d+|BOLETO[\s\-]?\d*|<\d+>)", text)
+    match = search_with_stats("document_reference", DOCUMENT_REFERENCE_PATTERN, text, DOCUMENT_REFERENCE_BRANCHES)
     return match.group(1).strip() if match else None
 
 
@@ -1,6 +1,16 @@
+import logging
 import os
 import pandas as pd
-from processors.grouping_logic import apply_grouping_logic, deduplicate_by_valor, remove_company_duplicates
+from processors.grouping_logic import (
+    apply_grouping_logic, deduplicate_grouped_records,
+    get_repeat_count, single_occurrence, REPEAT_COUNT_KEY, MAX_EXPANDED_ROWS
+)
+from utils.run_history import record_stem_rows
+
+logger = logging.getLogger(__name__)
+
+# Bookkeeping fields that are not written to the Excel files
+EXPORT_DROPPED_COLUMNS = ['source', 'sheet', 'processing_rule']
 
 
 def create_processing_summary(excel_data, composicoes_data, total_records, grouped_records_count):
@@ -45,63 +55,121 @@ def merge_file_records(file_stem, excel_data, composicoes_data):
     return file_records, excel_records_count, composicoes_records_count
 
 
-def create_merged_excel_files(excel_data, composicoes_data, output_folder="output"):
+def expand_repeated_records(records, max_expanded_rows=MAX_EXPANDED_ROWS):
+    expanded_records = []
+    collapsed_count = 0
 
-    os.makedirs(output_folder, exist_ok=True)
-    all_files = set(excel_data.keys()) | set(composicoes_data.keys())
+    for record in records:
+        repeat_count = get_repeat_count(record)
+        # A record without repeats is never "collapsed", even when nothing may be expanded (cap 0)
+        if max_expanded_rows is not None and repeat_count > max(max_expanded_rows, 1):
+            expanded_records.append(record)
+            collapsed_count += 1
+        else:
+            expanded_records.extend([single_occurrence(record)] * repeat_count)
 
-    print(f"\n{'='*50}")
-    print("CREATING MERGED EXCEL FILES")
-    print(f"{'='*50}")
+    return expanded_records, collapsed_count
 
-    total_grouped = 0
 
-    for file_stem in all_files:
+def group_stem_records(file_stem, excel_data, composicoes_data, max_expanded_rows=MAX_EXPANDED_ROWS,
+                       group_cache=None):
 
-        file_records, excel_count, composicoes_count = merge_file_records(
-            file_stem, excel_data, composicoes_data
-        )
-        print(f"✓ Merged {file_stem}: {len(file_records)} records (Excel: {excel_count}, Composicoes: {composicoes_count})")
+    file_records, excel_count, composicoes_count = merge_file_records(
+        file_stem, excel_data, composicoes_data
+    )
+    logger.info("✓ Merged %s: %d records (Excel: %d, Composicoes: %d)",
+                file_stem, len(file_records), excel_count, composicoes_count)
+    record_stem_rows(file_stem, len(file_records))
 
-        grouped_records = apply_grouping_logic(file_records)
-        grouped_records = [record for record in grouped_records if record.get("Valor_Total", 0) >= 0]
-        grouped_records = deduplicate_by_valor(grouped_records)
-        
-        records_before_company_dedup = len(grouped_records)
-        grouped_records = remove_company_duplicates(grouped_records)
-        records_after_company_dedup = len(grouped_records)
+    stem_cache = None if group_cache is None else group_cache.setdefault(file_stem, {})
+    grouped_records = apply_grouping_logic(file_records, max_expanded_rows=max_expanded_rows, cache=stem_cache)
+    grouped_records, removed = deduplicate_grouped_records(grouped_records)
+
+    if removed['negative_valor_total']:
+        logger.info("  🔄 Removed %d records with negative Valor_Total", removed['negative_valor_total'])
+    if removed['valor_duplicates']:
+        logger.info("  🔄 Removed %d value duplicates (same nota, empresa, Valor and Valor_Total)",
+                    removed['valor_duplicates'])
+    if removed['company_duplicates']:
+        logger.info("  🔄 Removed %d company duplicates (same valor_nota + Valor, different empresa)",
+                    removed['company_duplicates'])
+
+    return len(file_records), grouped_records
+
+
+def export_stem_records(file_stem, grouped_records, output_folder="output",
+                        expand_repeats=True, max_expanded_rows=MAX_EXPANDED_ROWS):
+
+    if not grouped_records:
+        logger.warning("  ⚠ No grouped records for '%s', skipping Excel file.", file_stem)
+        return 0
+
+    total_valor = round(sum(r.get('Valor', 0) * get_repeat_count(r) for r in grouped_records), 2)
+
+    cleaned_records = []
+    for record in grouped_records:
+        cleaned_record = {
+            k: v for k, v in record.items()
+            if k not in EXPORT_DROPPED_COLUMNS
+        }
+        cleaned_records.append(cleaned_record)
+
+    cleaned_records, collapsed_count = expand_repeated_records(
+        cleaned_records, max_expanded_rows if expand_repeats else 0
+    )
+    if collapsed_count:
+        logger.warning("  ⚠ %d repeated record(s) exported as one row with a '%s' column",
+                       collapsed_count, REPEAT_COUNT_KEY)
+
+    df_result = pd.DataFrame(cleaned_records)
+    if REPEAT_COUNT_KEY in df_result.columns:
+        df_result[REPEAT_COUNT_KEY] = df_result[REPEAT_COUNT_KEY].fillna(1).astype(int)
+
+    if not df_result.empty:
+        total_row = {col: '' for col in df_result.columns}
+        total_row['total da planilha'] = total_valor
         
-        if records_before_company_dedup != records_after_company_dedup:
-            removed_count = records_before_company_dedup - records_after_company_dedup
-            print(f"  🔄 Removed {removed_count} company duplicates (same valor_nota + Valor, different empresa)")
+        df_result = pd.concat([df_result, pd.DataFrame([total_row])], ignore_index=True)
 
-        if not grouped_records:
-            print(f"  ⚠ No grouped records for '{file_stem}', skipping Excel file.")
-            continue
+    output_path = os.path.join(output_folder, f"{file_stem}.xlsx")
+    df_result.to_excel(output_path, index=False)
+    exported_rows = sum(get_repeat_count(r) for r in cleaned_records)
+    logger.info("  💾 Saved Excel: %s (%d records + 1 total row)", output_path, len(cleaned_records))
 
-        total_valor = round(sum(r.get('Valor', 0) for r in grouped_records), 2)
+    return exported_rows
 
-        cleaned_records = []
-        for record in grouped_records:
-            cleaned_record = {
-                k: v for k, v in record.items()
-                if k not in ['source', 'sheet', 'processing_rule']
-            }
-            cleaned_records.append(cleaned_record)
 
-        df_result = pd.DataFrame(cleaned_records)
+def create_stem_excel_file(file_stem, excel_data, composicoes_data, output_folder="output",
+                           expand_repeats=True, max_expanded_rows=MAX_EXPANDED_ROWS, group_cache=None):
 
-        if not df_result.empty:
-            total_row = {col: '' for col in df_result.columns}
-            total_row['total da planilha'] = total_valor
-            
-            df_result = pd.concat([df_result, pd.DataFrame([total_row])], ignore_index=True)
+    original_count, grouped_records = group_stem_records(
+        file_stem, excel_data, composicoes_data, max_expanded_rows=max_expanded_rows,
+        group_cache=group_cache
+    )
+    exported_rows = export_stem_records(
+        file_stem, grouped_records, output_folder,
+        expand_repeats=expand_repeats, max_expanded_rows=max_expanded_rows
+    )
+    return original_count, exported_rows
 
-        output_path = os.path.join(output_folder, f"{file_stem}.xlsx")
-        df_result.to_excel(output_path, index=False)
-        print(f"  💾 Saved Excel: {output_path} ({len(cleaned_records)} records + 1 total row)")
 
-        total_grouped += len(cleaned_records)
+def create_merged_excel_files(excel_data, composicoes_data, output_folder="output",
+                              expand_repeats=True, max_expanded_rows=MAX_EXPANDED_ROWS, group_cache=None):
+
+    os.makedirs(output_folder, exist_ok=True)
+    all_files = set(excel_data.keys()) | set(composicoes_data.keys())
+
+    logger.info("\n%s\nCREATING MERGED EXCEL FILES\n%s", '='*50, '='*50)
+
+    total_grouped = 0
+
+    for file_stem in all_files:
+        _, exported_rows = create_stem_excel_file(
+            file_stem, excel_data, composicoes_data, output_folder,
+            expand_repeats=expand_repeats, max_expanded_rows=max_expanded_rows,
+            group_cache=group_cache
+        )
+        total_grouped += exported_rows
 
-    print(f"\n📊 Total grouped records saved across all files: {total_grouped}")
+    logger.info("\n📊 Total grouped records saved across all files: %d", total_grouped)
     #print(f"💰 Valor do empreendimento: R$ {valor_empreendimento_total:,.2f}")
\ No newline at end of file
@@ -1,75 +1,133 @@
+import logging
+import multiprocessing
 import os
+import queue
 import re
+import threading
 import pandas as pd
 from pathlib import Path
 from collections import defaultdict
-from utils.data_utils import prepare_dataframe_for_json, normalize_nota_field, clean_nan_from_records
+from utils.data_utils import (
+    coerce_json_types, normalize_nota_field, filter_valid_rows, valid_rows_mask,
+    compact_dataframe, records_bytes_per_row, log_memory_report
+)
+from utils.frame_exchange import frame_segments, publish_records, open_records, release_records
+from utils.logging_config import configure_logging
+from utils.pattern_stats import (
+    enable_pattern_stats, pattern_stats_enabled, reset_pattern_stats, drain_pattern_stats, merge_pattern_stats
+)
+from utils.regex_patterns import get_nota_pattern_order, set_nota_pattern_order
+from utils.run_history import add_stem_rows
 from parsers.complemento_parser import parse_complemento_column
+from processors.workbook_sniffer import open_workbook, sniff_workbook, read_sniffed_sheets, SNIFF_ROWS
+
+logger = logging.getLogger(__name__)
+
+# How many workbooks the read-ahead thread may hold decoded while the current one is parsed
+DEFAULT_PREFETCH_WORKBOOKS = 2
+
+RAZAO_HEADER_COLUMNS = ['Complemento']
+COMPOSICOES_SHEET = 'Fornecedores'
+COMPOSICOES_HEADER_COLUMNS = ['Descriçao', 'Valor']
+# Header position the composições layout used to be read with, kept for sheets where none is found
+DEFAULT_COMPOSICOES_SKIPROWS = 11
 
 
 def get_excel_files(folder_path):
     if not os.path.exists(folder_path):
-        print(f"Warning: Folder '{folder_path}' does not exist.")
+        logger.warning("Warning: Folder '%s' does not exist.", folder_path)
         return []
 
     excel_files = [file for file in os.listdir(folder_path) if file.endswith(('.xlsx', '.xls'))]
     return excel_files
 
 
-def process_single_composicoes_file(file_path, file_stem):
+def read_fornecedores_sheet(file_path, file_stem):
+    workbook = open_workbook(file_path)
+    if workbook is None:
+        return pd.read_excel(file_path, sheet_name=COMPOSICOES_SHEET, skiprows=DEFAULT_COMPOSICOES_SKIPROWS)
+
     try:
-        df = pd.read_excel(file_path, sheet_name='Fornecedores', skiprows=11)
-        df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+        sniffed = sniff_workbook(workbook, COMPOSICOES_HEADER_COLUMNS, sheet_names=[COMPOSICOES_SHEET])
+        if COMPOSICOES_SHEET not in sniffed:
+            logger.error("  ✗ Sheet 'Fornecedores' not found in %s", file_stem)
+            logger.error("    Available sheets: %s", workbook.sheetnames)
+            return None
 
-        if 'Valor' in df.columns:
-            df = df.dropna(subset=['Valor'])
-            print(f"  ✓ Removed rows with NaN 'Valor'")
-        else:
-            print(f"  ⚠ Warning: 'Valor' column not found in {file_stem}")
+        if sniffed[COMPOSICOES_SHEET]["header_row"] is None:
+            logger.warning("  ⚠ No %s header in the first %d rows of %s, reading from row %d",
+                           "/".join(COMPOSICOES_HEADER_COLUMNS), SNIFF_ROWS, file_stem, DEFAULT_COMPOSICOES_SKIPROWS + 1)
+            sniffed[COMPOSICOES_SHEET]["header_row"] = DEFAULT_COMPOSICOES_SKIPROWS
 
-        df_clean = prepare_dataframe_for_json(df)
+        return read_sniffed_sheets(workbook, sniffed)[COMPOSICOES_SHEET]
+    finally:
+        workbook.close()
 
-        for col in df_clean.columns:
-            if df_clean[col].dtype == 'object':
-                df_clean[col] = df_clean[col].astype(str).str.strip()
 
-        df_transformed = df_clean.rename(columns={
-            "Mês": "nota",
-            "NF-s": "nota", 
-            "Descriçao": "empresa",
-            "Valor": "soma"
-        })
+def fornecedores_records(df, file_stem):
+    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
 
-        if "Saldo" in df_transformed.columns:
-            df_transformed = df_transformed.drop(columns=["Saldo"])
+    if 'Valor' in df.columns:
+        df = df.dropna(subset=['Valor'])
+        logger.info("  ✓ Removed rows with NaN 'Valor'")
+    else:
+        logger.warning("  ⚠ Warning: 'Valor' column not found in %s", file_stem)
 
-        records = df_transformed.to_dict('records')
+    df_clean = coerce_json_types(df, strip_strings=True)
 
-        processed_records = []
-        for r in records:
-            r = normalize_nota_field(r)
-            try:
-                r['nota'] = int(re.sub(r'\D', '', str(r.get('nota', ''))))
-            except (ValueError, TypeError):
-                r['nota'] = None
-            processed_records.append(r)
+    df_transformed = df_clean.rename(columns={
+        "Mês": "nota",
+        "NF-s": "nota", 
+        "Descriçao": "empresa",
+        "Valor": "soma"
+    })
+
+    if "Saldo" in df_transformed.columns:
+        df_transformed = df_transformed.drop(columns=["Saldo"])
+
+    records = df_transformed.to_dict('records')
 
-        print(f"  ✓ Successfully processed 'Fornecedores' sheet ({len(processed_records)} records)")
-        return processed_records
+    processed_records = []
+    for r in records:
+        r = normalize_nota_field(r)
+        try:
+            r['nota'] = int(re.sub(r'\D', '', str(r.get('nota', ''))))
+        except (ValueError, TypeError):
+            r['nota'] = None
+        processed_records.append(r)
+
+    logger.info("  ✓ Successfully processed 'Fornecedores' sheet (%d records)", len(processed_records))
+    return processed_records
+
+
+def parse_single_composicoes_file(file_path, file_stem):
+    """Like process_single_composicoes_file, but a workbook that cannot be read raises instead of giving []"""
+    df = read_fornecedores_sheet(file_path, file_stem)
+    if df is None:
+        raise ValueError(f"Sheet '{COMPOSICOES_SHEET}' not found in {file_stem}")
+    return fornecedores_records(df, file_stem)
+
+
+def process_single_composicoes_file(file_path, file_stem):
+    try:
+        df = read_fornecedores_sheet(file_path, file_stem)
+        if df is None:
+            return []
+        return fornecedores_records(df, file_stem)
 
     except ValueError as e:
         if "Worksheet named 'Fornecedores' not found" in str(e):
-            print(f"  ✗ Sheet 'Fornecedores' not found in {file_stem}")
+            logger.error("  ✗ Sheet 'Fornecedores' not found in %s", file_stem)
             try:
                 xl_file = pd.ExcelFile(file_path)
-                print(f"    Available sheets: {xl_file.sheet_names}")
+                logger.error("    Available sheets: %s", xl_file.sheet_names)
             except Exception:
                 pass
         else:
-            print(f"  ✗ Error reading {file_stem}: {e}")
+            logger.error("  ✗ Error reading %s: %s", file_stem, e)
         return []
     except Exception as e:
-        print(f"  ✗ Error processing {file_stem}: {e}")
+        logger.error("  ✗ Error processing %s: %s", file_stem, e)
         return []
 
 
@@ -115,114 +173,352 @@ def check_empresa_against_composicoes(records, composicoes_lookup):
             
             if has_nota_in_composicoes:
                 records_to_remove.extend(empresa_records)
-                print(f"  🗑️  Removing empresa '{empresa}' (sum=0, found in composicoes)")
+                logger.debug("  🗑️  Removing empresa '%s' (sum=0, found in composicoes)", empresa)
     
     return records_to_remove
 
 
-def process_single_excel_file(file_path, composicoes_lookup=None):
+def read_excel_sheets(file_path):
+    workbook = open_workbook(file_path)
+    if workbook is None:
+        return pd.read_excel(file_path, sheet_name=None)
+
     try:
-        print(f"Processing excel: {file_path.name}")
-        excel_sheets = pd.read_excel(file_path, sheet_name=None)
-        
-        file_data = {}
-        file_soma_total = 0.0
-
-        for sheet_name, df in excel_sheets.items():
-            df = parse_complemento_column(df) 
-            print(df[["Complemento", "nota", "empresa", "Débito", "Crédito", "soma"]])
-            records = df.to_dict('records')
-            cleaned_records = clean_nan_from_records(records) 
-
-            if composicoes_lookup is not None:
-                records_to_remove = check_empresa_against_composicoes(cleaned_records, composicoes_lookup)
-                if records_to_remove:
-                    records_to_remove_set = set(id(r) for r in records_to_remove)
-                    cleaned_records = [r for r in cleaned_records if id(r) not in records_to_remove_set]
-                    print(f"  📊 Removed {len(records_to_remove)} records due to composicoes cross-check")
-
-            soma_notas_sheet_total = sum(
-                float(r['soma_notas']) for r in cleaned_records if 'soma_notas' in r
-            )
-            file_soma_total += soma_notas_sheet_total
+        sniffed = sniff_workbook(workbook, RAZAO_HEADER_COLUMNS)
+        skipped = [sheet_name for sheet_name, info in sniffed.items() if info["header_row"] is None]
+        if skipped:
+            logger.info("  ⏭️  Skipping sheet(s) without a 'Complemento' column: %s", ", ".join(skipped))
+        return read_sniffed_sheets(workbook, sniffed)
+    finally:
+        workbook.close()
+
+
+def parse_sheet_lines(sheet_name, df, memory_report=False):
+    """Every line of the sheet with nota and empresa extracted, before invalid lines are dropped."""
+    df = parse_complemento_column(df)
+    # Measured on the record dicts the sheet ends up as in excel_data, not on the frame
+    bytes_before = records_bytes_per_row(df.to_dict('records')) if memory_report else None
+    df = compact_dataframe(df)
+    if memory_report:
+        log_memory_report(f"sheet '{sheet_name}'", bytes_before, records_bytes_per_row(df.to_dict('records')))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", df[["Complemento", "nota", "empresa", "Débito", "Crédito", "soma"]])
+    return df
+
+
+def parse_sheet(sheet_name, df, memory_report=False):
+    df = parse_sheet_lines(sheet_name, df, memory_report=memory_report)
+    return filter_valid_rows(df), len(df)
+
+
+def parse_excel_lines(file_path, memory_report=False):
+    """
+    {sheet_name: (records, valid flags)} with every parsed line of the workbook, including
+    the ones grouping drops (no nota or empresa, a missing value, soma_notas of 0). Errors propagate.
+    """
+    logger.info("Processing excel: %s", file_path.name)
+    sheets = {}
+    for sheet_name, df in read_excel_sheets(file_path).items():
+        df = parse_sheet_lines(sheet_name, df, memory_report=memory_report)
+        sheets[sheet_name] = (df.to_dict('records'), valid_rows_mask(df).tolist())
+    return sheets
+
+
+def parse_excel_sheets(file_path, memory_report=False, excel_sheets=None):
+    if excel_sheets is None:
+        excel_sheets = read_excel_sheets(file_path)
+
+    return {
+        sheet_name: parse_sheet(sheet_name, df, memory_report=memory_report)
+        for sheet_name, df in excel_sheets.items()
+    }
+
+
+def clean_sheet_records(cleaned_records, composicoes_lookup=None):
+    cross_check_removed = 0
+
+    if composicoes_lookup is not None:
+        records_to_remove = check_empresa_against_composicoes(cleaned_records, composicoes_lookup)
+        if records_to_remove:
+            records_to_remove_set = set(id(r) for r in records_to_remove)
+            cleaned_records = [r for r in cleaned_records if id(r) not in records_to_remove_set]
+            cross_check_removed = len(records_to_remove)
+
+    soma_notas_sheet_total = sum(
+        float(r['soma_notas']) for r in cleaned_records if 'soma_notas' in r
+    )
+    return cleaned_records, cross_check_removed, soma_notas_sheet_total
+
+
+def process_sheet(task):
+    """Parse, clean and cross-check one sheet; runs in a sheet pool worker or inline."""
+    sheet_name, df, composicoes_lookup, memory_report = task
+    valid_df, total_rows = parse_sheet(sheet_name, df, memory_report=memory_report)
+    return (*clean_sheet_records(valid_df.to_dict('records'), composicoes_lookup), total_rows)
+
+
+def process_sheet_in_worker(task):
+    return process_sheet(task), drain_pattern_stats()
+
+
+def init_worker(collect_pattern_stats, nota_order):
+    """
+    Pool initializer. Workers start from the main process's pattern settings, with empty
+    counters; what they count comes back with each result and is merged by the main process.
+    """
+    configure_logging()
+    reset_pattern_stats()
+    if collect_pattern_stats:
+        enable_pattern_stats()
+    set_nota_pattern_order(nota_order)
 
-            file_data[sheet_name] = {
-                "records": cleaned_records,
-                "soma_notas_total": round(soma_notas_sheet_total, 2)
-            }
 
-            removed_count = len(records) - len(cleaned_records)
-            if removed_count > 0:
-                print(f"  Sheet '{sheet_name}': Removed {removed_count} records total")
+def start_worker_pool(processes):
+    return multiprocessing.Pool(processes, initializer=init_worker,
+                                initargs=(pattern_stats_enabled(), get_nota_pattern_order()))
 
-        print(f"  ✓ Processed {file_path.name} (Total: R$ {file_soma_total:,.2f})")
-        return file_data, file_soma_total
 
+def merge_worker_results(results):
+    for result, pattern_stats in results:
+        merge_pattern_stats(pattern_stats)
+        yield result
+
+
+def merge_sheet_results(file_path, sheet_results):
+    """Build file_data from (sheet_name, result) pairs in workbook sheet order, whoever computed them."""
+    file_data = {}
+    file_soma_total = 0.0
+
+    for sheet_name, (cleaned_records, cross_check_removed, soma_notas_sheet_total, total_rows) in sheet_results:
+        if cross_check_removed:
+            logger.info("  📊 Removed %d records due to composicoes cross-check", cross_check_removed)
+
+        file_soma_total += soma_notas_sheet_total
+
+        file_data[sheet_name] = {
+            "records": cleaned_records,
+            "soma_notas_total": round(soma_notas_sheet_total, 2)
+        }
+
+        removed_count = total_rows - len(cleaned_records)
+        if removed_count > 0:
+            logger.info("  Sheet '%s': Removed %d records total", sheet_name, removed_count)
+
+    logger.info("  ✓ Processed %s (Total: R$ %s)", file_path.name, f"{file_soma_total:,.2f}")
+    return file_data, file_soma_total
+
+
+def build_file_data(file_path, parsed_sheets, composicoes_lookup=None):
+    return merge_sheet_results(file_path, (
+        (sheet_name, (*clean_sheet_records(records, composicoes_lookup), total_rows))
+        for sheet_name, (records, total_rows) in parsed_sheets.items()
+    ))
+
+
+def parse_single_excel_file(file_path, composicoes_lookup=None, memory_report=False, excel_sheets=None,
+                            sheet_pool=None):
+    """Like process_single_excel_file, but errors propagate instead of giving ({}, 0.0)"""
+    logger.info("Processing excel: %s", file_path.name)
+    if excel_sheets is None:
+        excel_sheets = read_excel_sheets(file_path)
+
+    tasks = [(sheet_name, df, composicoes_lookup, memory_report) for sheet_name, df in excel_sheets.items()]
+    if sheet_pool is not None and len(tasks) > 1:
+        # imap hands results back in sheet order, so totals are summed exactly as in a serial run
+        sheet_results = merge_worker_results(sheet_pool.imap(process_sheet_in_worker, tasks))
+    else:
+        sheet_results = map(process_sheet, tasks)
+
+    return merge_sheet_results(file_path, zip(excel_sheets, sheet_results))
+
+
+def process_single_excel_file(file_path, composicoes_lookup=None, memory_report=False, excel_sheets=None,
+                              sheet_pool=None):
+    try:
+        return parse_single_excel_file(file_path, composicoes_lookup, memory_report=memory_report,
+                                       excel_sheets=excel_sheets, sheet_pool=sheet_pool)
     except Exception as e:
-        print(f"  ✗ Error processing {file_path.name}: {str(e)}")
+        logger.error("  ✗ Error processing %s: %s", file_path.name, e)
         return {}, 0.0
 
 
+def prefetch_workbooks(excel_files, depth=DEFAULT_PREFETCH_WORKBOOKS):
+    """
+    Yield (file_path, sheets, error) in order while a background thread unzips and decodes
+    the next workbooks, at most depth of them waiting in the buffer.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def read_ahead():
+        for file_path in excel_files:
+            try:
+                item = (file_path, read_excel_sheets(file_path), None)
+            except Exception as e:
+                item = (file_path, None, e)
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                return
+
+    reader = threading.Thread(target=read_ahead, name="workbook-prefetch", daemon=True)
+    reader.start()
+    try:
+        for _ in excel_files:
+            yield buffer.get()
+    finally:
+        stop.set()
+        reader.join()
+
+
+def process_prefetched_excel_files(excel_files, composicoes_lookup, memory_report, depth, sheet_pool=None):
+    for file_path, excel_sheets, error in prefetch_workbooks(excel_files, depth):
+        if error is not None:
+            logger.info("Processing excel: %s", file_path.name)
+            logger.error("  ✗ Error processing %s: %s", file_path.name, error)
+            yield file_path, {}, 0.0
+            continue
+        yield (file_path, *process_single_excel_file(
+            file_path, composicoes_lookup, memory_report=memory_report, excel_sheets=excel_sheets,
+            sheet_pool=sheet_pool
+        ))
+
+
+def publish_excel_file(task):
+    """Worker side of a multi-process ingest: parse one workbook and publish its sheets."""
+    file_path, file_index, segment_dir, memory_report = task
+    try:
+        logger.info("Processing excel: %s", file_path.name)
+        parsed_sheets = parse_excel_sheets(file_path, memory_report=memory_report)
+    except Exception as e:
+        logger.error("  ✗ Error processing %s: %s", file_path.name, e)
+        return None, drain_pattern_stats()
+
+    published = {
+        sheet_name: (publish_records(valid_df, segment_dir, f"{file_index}-{sheet_index}"), total_rows)
+        for sheet_index, (sheet_name, (valid_df, total_rows)) in enumerate(parsed_sheets.items())
+    }
+    return published, drain_pattern_stats()
+
+
+def open_published_sheets(published):
+    parsed_sheets = {}
+    for sheet_name, (path, total_rows) in published.items():
+        parsed_sheets[sheet_name] = (open_records(path), total_rows)
+        release_records(path)
+    return parsed_sheets
+
+
+def process_excel_files_in_parallel(excel_files, composicoes_lookup, memory_report, processes):
+    logger.info("⚙️  Parsing with %d processes", processes)
+
+    with frame_segments() as segment_dir, start_worker_pool(processes) as pool:
+        tasks = [(file_path, index, segment_dir, memory_report) for index, file_path in enumerate(excel_files)]
+
+        # imap keeps the workbook order, so the result does not depend on which worker finished first
+        results = merge_worker_results(pool.imap(publish_excel_file, tasks))
+        for file_path, published in zip(excel_files, results):
+            if published is None:
+                yield file_path, {}, 0.0
+                continue
+            try:
+                file_data, file_soma_total = build_file_data(
+                    file_path, open_published_sheets(published), composicoes_lookup
+                )
+            except Exception as e:
+                logger.error("  ✗ Error processing %s: %s", file_path.name, e)
+                file_data, file_soma_total = {}, 0.0
+            yield file_path, file_data, file_soma_total
+
+
 def process_composicoes_folder(folder_path="composicoes"):
 
     excel_files = get_excel_files(folder_path)
     
     if not excel_files:
-        print(f"No Excel files found in '{folder_path}' folder.")
+        logger.warning("No Excel files found in '%s' folder.", folder_path)
         return {}
 
-    print(f"Found {len(excel_files)} Excel file(s) in '{folder_path}' folder")
+    logger.info("Found %d Excel file(s) in '%s' folder", len(excel_files), folder_path)
 
     fornecedores_data = {}
 
     for file in excel_files:
         file_path = os.path.join(folder_path, file)
         file_stem = Path(file).stem
-        print(f"Processing composicoes: {file}")
+        logger.info("Processing composicoes: %s", file)
 
         records = process_single_composicoes_file(file_path, file_stem)
         fornecedores_data[file_stem] = records
+        add_stem_rows(file_stem, len(records))
 
     return fornecedores_data
 
 
-def process_excel_folder(excel_folder="razoes", fornecedores_data=None):
+def process_excel_folder(excel_folder="razoes", fornecedores_data=None, memory_report=False, processes=1,
+                         prefetch=DEFAULT_PREFETCH_WORKBOOKS, sheet_processes=1):
 
     excel_files = []
     for ext in ['*.xlsx', '*.xls']:
         excel_files.extend(Path(excel_folder).glob(ext))
 
     if not excel_files:
-        print(f"No Excel files found in '{excel_folder}' folder")
+        logger.warning("No Excel files found in '%s' folder", excel_folder)
         return {}
 
-    print(f"Found {len(excel_files)} Excel file(s) in '{excel_folder}' folder")
+    logger.info("Found %d Excel file(s) in '%s' folder", len(excel_files), excel_folder)
     
     composicoes_lookup = None
     if fornecedores_data:
         composicoes_lookup = build_composicoes_lookup(fornecedores_data)
-        print(f"📋 Built composicoes lookup with {len(composicoes_lookup)} empresa-nota combinations")
+        logger.info("📋 Built composicoes lookup with %d empresa-nota combinations", len(composicoes_lookup))
     
     excel_data = {}
     soma_notas_grand_total = 0.0
 
-    for file_path in excel_files:
-        file_stem = file_path.stem
-        file_data, file_soma_total = process_single_excel_file(file_path, composicoes_lookup)
-        
-        excel_data[file_stem] = file_data
-        soma_notas_grand_total += file_soma_total
+    # Workbooks already spread over processes cannot start their own sheet pools
+    sheet_pool = None
+    if sheet_processes > 1 and processes <= 1:
+        logger.info("⚙️  Processing sheets with %d processes", sheet_processes)
+        sheet_pool = start_worker_pool(sheet_processes)
+
+    try:
+        if processes > 1 and len(excel_files) > 1:
+            processed_files = process_excel_files_in_parallel(excel_files, composicoes_lookup, memory_report, processes)
+        elif prefetch > 0 and len(excel_files) > 1:
+            processed_files = process_prefetched_excel_files(excel_files, composicoes_lookup, memory_report, prefetch,
+                                                             sheet_pool=sheet_pool)
+        else:
+            processed_files = (
+                (file_path, *process_single_excel_file(file_path, composicoes_lookup, memory_report=memory_report,
+                                                       sheet_pool=sheet_pool))
+                for file_path in excel_files
+            )
 
-    print(f"🔢 Excel folder total: R$ {soma_notas_grand_total:,.2f}")
+        for file_path, file_data, file_soma_total in processed_files:
+            file_stem = file_path.stem
+            excel_data[file_stem] = file_data
+            add_stem_rows(file_stem, sum(len(sheet_data["records"]) for sheet_data in file_data.values()))
+            soma_notas_grand_total += file_soma_total
+    finally:
+        if sheet_pool is not None:
+            sheet_pool.close()
+            sheet_pool.join()
+
+    logger.info("🔢 Excel folder total: R$ %s", f"{soma_notas_grand_total:,.2f}")
     return excel_data
 
 
 def process_both_folders(excel_folder="excel", composicoes_folder="composicoes"):
 
-    print("=== Processing Composicoes Folder ===")
+    logger.info("=== Processing Composicoes Folder ===")
     fornecedores_data = process_composicoes_folder(composicoes_folder)
     
-    print("\n=== Processing Excel Folder with Composicoes Cross-Check ===")
+    logger.info("\n=== Processing Excel Folder with Composicoes Cross-Check ===")
     excel_data = process_excel_folder(excel_folder, fornecedores_data)
     
     return excel_data, fornecedores_data
\ No newline at end of file
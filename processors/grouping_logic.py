@@ -1,4 +1,18 @@
+import hashlib
+import json
+import logging
 import pandas as pd
+from utils.artifacts import json_default
+from utils.data_utils import compact_dataframe
+
+logger = logging.getLogger(__name__)
+
+REPEAT_COUNT_KEY = 'quantidade'
+MAX_EXPANDED_ROWS = 10000
+
+# Bump when the grouping or cancellation rules change, so cached results stop matching.
+GROUP_CACHE_VERSION = 1
+GROUP_HASH_COLUMNS = ['soma', 'soma_notas', 'source', 'sheet']
 
 
 def safe_float_conversion(value):
@@ -17,21 +31,70 @@ def safe_float_conversion(value):
         try:
             return float(cleaned_value)
         except ValueError:
-            print(f"Warning: Could not convert '{value}' to float, returning 0.0")
+            logger.warning("Warning: Could not convert '%s' to float, returning 0.0", value)
             return 0.0
     
     try:
         return float(value)
     except (ValueError, TypeError):
-        print(f"Warning: Could not convert '{value}' to float, returning 0.0")
+        logger.warning("Warning: Could not convert '%s' to float, returning 0.0", value)
         return 0.0
 
 
-def deduplicate_by_valor(records):
+def get_repeat_count(record):
+    return record.get(REPEAT_COUNT_KEY, 1)
+
+
+def single_occurrence(record):
+    if REPEAT_COUNT_KEY not in record:
+        return record
+    return {k: v for k, v in record.items() if k != REPEAT_COUNT_KEY}
+
+
+def group_content_hashes(df_filtered, grouped):
+    """Content hash of every (empresa, nota) group, hashing the rows of the whole frame in one pass."""
+    columns = [col for col in GROUP_HASH_COLUMNS if col in df_filtered.columns]
+    row_hashes = pd.util.hash_pandas_object(df_filtered[columns], index=False).values
+
+    hashes = {}
+    for (empresa, nota), positions in grouped.indices.items():
+        digest = hashlib.sha1(json.dumps([GROUP_CACHE_VERSION, empresa, nota, columns], default=json_default).encode())
+        digest.update(row_hashes[positions].tobytes())
+        hashes[(empresa, nota)] = digest.hexdigest()
+    return hashes
+
+
+def records_content_hash(empresa, records):
+    payload = json.dumps([GROUP_CACHE_VERSION, empresa, records], default=json_default, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def has_company_sigla(empresa):
+    return any(sigla in empresa for sigla in ['LTDA', 'S.A', 'S/A'])
+
+
+def deduplicate_grouped_records(records):
+    """
+    Single pass equivalent of filtering Valor_Total >= 0, deduplicate_by_valor and
+    remove_company_duplicates (kept in processors/reference_grouping.py), normalizing
+    every record only once.
+    Returns the filtered records and the number of records removed by each rule.
+    """
+    removed = {
+        'negative_valor_total': 0,
+        'valor_duplicates': 0,
+        'company_duplicates': 0
+    }
+
+    # Rules 1 and 2: (record, valor, normalized empresa) for every surviving record
+    distinct_values = []
     deduped = {}
-    result = []
 
     for record in records:
+        if not record.get("Valor_Total", 0) >= 0:
+            removed['negative_valor_total'] += 1
+            continue
+
         nota = int(record.get("nota")) if record.get("nota") is not None else None
         empresa = record.get("empresa", "").strip().upper()
         valor = safe_float_conversion(record.get("Valor"))
@@ -39,71 +102,77 @@ def deduplicate_by_valor(records):
 
         if valor == valor_total:
             key = (nota, empresa, valor, valor_total)
+            if key in deduped:
+                removed['valor_duplicates'] += 1
             if key not in deduped or record.get("source") == "excel":
                 deduped[key] = {
-                    **record,
+                    **single_occurrence(record),
                     "nota": nota,
                     "Valor": valor,
                     "Valor_Total": valor_total
                 }
         else:
-            result.append(record)
+            distinct_values.append((record, valor, empresa))
 
-    result.extend(deduped.values())
-    return result
+    distinct_values.extend((record, key[2], key[1]) for key, record in deduped.items())
 
-
-def remove_company_duplicates(records):
-    if not records:
-        return records
+    # Rule 3: same valor_nota + Valor under different empresas keeps a single record
     groups = {}
-    for record in records:
-        valor_nota = record.get('valor_nota', '')
-        valor = safe_float_conversion(record.get('Valor', 0))
-        key = (valor_nota, valor)
-        
-        if key not in groups:
-            groups[key] = []
-        groups[key].append(record)
-    
+    for record, valor, empresa in distinct_values:
+        groups.setdefault((record.get('valor_nota', ''), valor), []).append((record, empresa))
+
     filtered_records = []
+    for group in groups.values():
+        if len(group) == 1 or len({empresa for _, empresa in group}) <= 1:
+            filtered_records.extend(record for record, _ in group)
+            continue
+
+        kept = next(
+            (record for record, empresa in group if not has_company_sigla(empresa)),
+            group[0][0]
+        )
+        filtered_records.append(single_occurrence(kept))
+        removed['company_duplicates'] += len(group) - 1
+
+    return filtered_records, removed
+
+
+def cancel_empresa_records(empresa, records):
+    logger.debug("\nProcessing cancellations for empresa: '%s'", empresa)
+    logger.debug("  Records before cancellation: %d", len(records))
     
-    for key, group_records in groups.items():
-        if len(group_records) == 1:
-            filtered_records.extend(group_records)
-        else:
-            empresas_diferentes = set()
-            for record in group_records:
-                empresa = record.get('empresa', '').strip().upper()
-                empresas_diferentes.add(empresa)
+    to_cancel = set()
+
+    for i, record1 in enumerate(records):
+        if i in to_cancel:
+            continue
             
-            if len(empresas_diferentes) <= 1:
-                filtered_records.extend(group_records)
-            else:
-                records_sem_siglas = []
-                records_com_siglas = []
-                
-                for record in group_records:
-                    empresa = record.get('empresa', '').strip().upper()
-                    tem_sigla = any(sigla in empresa for sigla in ['LTDA', 'S.A', 'S/A'])
-                    
-                    if tem_sigla:
-                        records_com_siglas.append(record)
-                    else:
-                        records_sem_siglas.append(record)
+        valor1 = safe_float_conversion(record1['Valor'])
+        
+        for j, record2 in enumerate(records[i+1:], i+1):
+            if j in to_cancel:
+                continue
                 
-                if records_sem_siglas:
-                    filtered_records.append(records_sem_siglas[0])
-                else:
-                    filtered_records.append(records_com_siglas[0])
+            valor2 = safe_float_conversion(record2['Valor'])
+            
+            if abs(valor1 + valor2) < 0.01:
+                logger.debug("  ✓ Cancelling: %s + %s = %s\n    Record 1: Nota %s, Valor %s\n    Record 2: Nota %s, Valor %s",
+                             valor1, valor2, valor1 + valor2, record1['nota'], valor1, record2['nota'], valor2)
+                to_cancel.add(i)
+                to_cancel.add(j)
+                break 
     
-    return filtered_records
+    remaining_records = [record for i, record in enumerate(records) if i not in to_cancel]
+    
+    logger.debug("  Records after cancellation: %d", len(remaining_records))
+    if len(remaining_records) != len(records):
+        logger.debug("  ✓ Cancelled %d records", len(records) - len(remaining_records))
+
+    return remaining_records
 
 
-def cancel_opposing_values(grouped_results):
-    print(f"\n{'='*50}")
-    print("APPLYING CANCELLATION LOGIC")
-    print(f"{'='*50}")
+def cancel_opposing_values(grouped_results, cache=None):
+    logger.info("\n%s\nAPPLYING CANCELLATION LOGIC\n%s", '='*50, '='*50)
     
     rule2_records = []
     other_records = []
@@ -114,8 +183,10 @@ def cancel_opposing_values(grouped_results):
         else:
             other_records.append(record)
     
-    print(f"Records from rule 2 (equal_values_division): {len(rule2_records)} - EXCLUDED from cancellation")
-    print(f"Records from other rules: {len(other_records)} - WILL BE processed for cancellation")
+    rule2_rows = sum(get_repeat_count(record) for record in rule2_records)
+    logger.info("Records from rule 2 (equal_values_division): %d (%d rows) - EXCLUDED from cancellation",
+                len(rule2_records), rule2_rows)
+    logger.info("Records from other rules: %d - WILL BE processed for cancellation", len(other_records))
     
     empresa_groups = {}
     for record in other_records:
@@ -125,167 +196,190 @@ def cancel_opposing_values(grouped_results):
         empresa_groups[empresa].append(record)
     
     final_results = []
-    
+    cancellations_cache = None if cache is None else cache.get('cancellations', {})
+    used_cancellations = {}
+    reused = 0
+
     for empresa, records in empresa_groups.items():
-        print(f"\nProcessing cancellations for empresa: '{empresa}'")
-        print(f"  Records before cancellation: {len(records)}")
-        
-        to_cancel = set()
+        if cache is None:
+            final_results.extend(cancel_empresa_records(empresa, records))
+            continue
 
-        for i, record1 in enumerate(records):
-            if i in to_cancel:
-                continue
-                
-            valor1 = safe_float_conversion(record1['Valor'])
-            
-            for j, record2 in enumerate(records[i+1:], i+1):
-                if j in to_cancel:
-                    continue
-                    
-                valor2 = safe_float_conversion(record2['Valor'])
-                
-                if abs(valor1 + valor2) < 0.01:
-                    print(f"  ✓ Cancelling: {valor1} + {valor2} = {valor1 + valor2}")
-                    print(f"    Record 1: Nota {record1['nota']}, Valor {valor1}")
-                    print(f"    Record 2: Nota {record2['nota']}, Valor {valor2}")
-                    to_cancel.add(i)
-                    to_cancel.add(j)
-                    break 
-        
-        remaining_records = [record for i, record in enumerate(records) if i not in to_cancel]
+        key = records_content_hash(empresa, records)
+        if key in cancellations_cache:
+            remaining_records = [dict(record) for record in cancellations_cache[key]]
+            reused += 1
+        else:
+            remaining_records = cancel_empresa_records(empresa, records)
+        used_cancellations[key] = remaining_records
         final_results.extend(remaining_records)
-        
-        print(f"  Records after cancellation: {len(remaining_records)}")
-        if len(remaining_records) != len(records):
-            print(f"  ✓ Cancelled {len(records) - len(remaining_records)} records")
+
+    if cache is not None:
+        cache['cancellations'] = used_cancellations
+        logger.info("♻️  Cancellation reused for %d of %d empresa(s)", reused, len(empresa_groups))
     
     final_results.extend(rule2_records)
     
-    print(f"\n✓ Cancellation logic completed")
-    print(f"✓ Records before cancellation: {len(other_records)} (rule 2 records excluded)")
-    print(f"✓ Records after cancellation: {len(final_results) - len(rule2_records)}")
-    print(f"✓ Rule 2 records added back: {len(rule2_records)}")
-    print(f"✓ Total final records: {len(final_results)}")
+    logger.info("\n✓ Cancellation logic completed")
+    logger.info("✓ Records before cancellation: %d (rule 2 records excluded)", len(other_records))
+    logger.info("✓ Records after cancellation: %d", len(final_results) - len(rule2_records))
+    logger.info("✓ Rule 2 records added back: %d", len(rule2_records))
+    logger.info("✓ Total final records: %d", len(final_results))
     
     return final_results
 
 
-def apply_grouping_logic(all_records):
+def group_key_records(empresa, nota, group, max_expanded_rows=MAX_EXPANDED_ROWS):
+    results = []
+    logger.debug("\nProcessing group: Empresa='%s', Nota='%s'", empresa, nota)
+    logger.debug("  Records in group: %d", len(group))
+    
+    # Convert soma values to float safely
+    soma_values = [safe_float_conversion(val) for val in group['soma'].dropna().tolist()]
+    soma_notas_values = [safe_float_conversion(val) for val in group['soma_notas'].dropna().tolist()]
+    
+    if not soma_values:
+        logger.debug("  ⚠ No valid soma values found, skipping group")
+        return results
+    
+    logger.debug("  Soma values: %s", soma_values)
+    logger.debug("  Soma_notas values: %s", soma_notas_values)
+    
+    if len(group) == 1:
+        logger.debug("  ✓ Rule 1 applied: Single record, keeping as-is")
+        single_record = group.iloc[0]
+        soma_value = safe_float_conversion(single_record['soma'])
+        soma_notas_value = safe_float_conversion(soma_notas_values[0] if soma_notas_values else single_record['soma'])
+        
+        results.append({
+            'nota': nota,
+            'empresa': empresa,
+            'Valor': round(soma_value, 2),
+            'Valor_Total': round(soma_notas_value, 2),
+            'source': single_record.get('source', 'unknown'),
+            'sheet': single_record.get('sheet', 'unknown'),
+            'processing_rule': 'single_record'
+        })
+        return results
+    
+    soma_values_int = [int(val) for val in soma_values]
+    unique_soma_values = list(set(soma_values_int))
+    
+    if len(unique_soma_values) == 1:
+        unit_value_int = unique_soma_values[0]
+        
+        total_value = soma_notas_values[0] if soma_notas_values else sum(soma_values)
+        
+        if unit_value_int != 0:
+            num_rows = abs(total_value / unit_value_int)
+            logger.debug("  ✓ Rule 2 applied: Multiple records with all values equal (integer part only: %s)", unit_value_int)
+            logger.debug("  ✓ Total value: %s, Unit value (int): %s", total_value, unit_value_int)
+            logger.debug("  ✓ Number of rows to create: %s", num_rows)
+            
+            original_unit_value = soma_values[0]
+            repeat_count = int(num_rows)
+
+            if max_expanded_rows is not None and repeat_count > max_expanded_rows:
+                logger.warning("  ⚠ Pathological expansion for Empresa='%s', Nota='%s': %d rows exceeds the cap of %d",
+                               empresa, nota, repeat_count, max_expanded_rows)
+
+            if repeat_count > 0:
+                results.append({
+                    'nota': nota,
+                    'empresa': empresa,
+                    'Valor': round(original_unit_value, 2),
+                    'Valor_Total': round(total_value, 2),
+                    'source': group.iloc[0].get('source', 'unknown'),
+                    'sheet': group.iloc[0].get('sheet', 'unknown'),
+                    'processing_rule': 'equal_values_division',
+                    REPEAT_COUNT_KEY: repeat_count
+                })
+        else:
+            logger.debug("  ⚠ Unit value is 0, skipping division")
+    else:
+        total_soma = sum(soma_values)
+        total_soma_notas = soma_notas_values[0] if soma_notas_values else total_soma
+        
+        logger.debug("  ✓ Rule 3 applied: Multiple records with different values")
+        logger.debug("  ✓ Total soma: %s", total_soma)
+        logger.debug("  ✓ Total soma_notas: %s", total_soma_notas)
+        
+        if abs(total_soma - total_soma_notas) < 0.01:
+            logger.debug("  ✓ Sum equals soma_nota, creating single row")
+            results.append({
+                'nota': nota,
+                'empresa': empresa,
+                'Valor': round(total_soma, 2),
+                'Valor_Total': round(total_soma_notas, 2),
+                'source': group.iloc[0].get('source', 'unknown'),
+                'sheet': group.iloc[0].get('sheet', 'unknown'),
+                'processing_rule': 'different_values_sum'
+            })
+        else:
+            logger.debug("  ⚠ Sum (%s) does not equal soma_nota (%s)", total_soma, total_soma_notas)
+            results.append({
+                'nota': nota,
+                'empresa': empresa,
+                'Valor': round(total_soma, 2),
+                'Valor_Total': round(total_soma_notas, 2),
+                'source': group.iloc[0].get('source', 'unknown'),
+                'sheet': group.iloc[0].get('sheet', 'unknown'),
+                'processing_rule': 'different_values_sum_discrepancy'
+            })
+
+    return results
+
+
+def apply_grouping_logic(all_records, max_expanded_rows=MAX_EXPANDED_ROWS, cache=None):
     """
     Apply the grouping logic before creating JSON:
     1. Filter by empresa and nota number
     2. If single record, keep as-is
     3. If multiple records with all integer parts of soma values equal, divide total by unit value to get number of rows
+       (kept as a single record carrying the row count in 'quantidade', expanded at export time)
     4. If multiple records with different values, sum them all together
     5. Cancel opposing values for same empresa
     """
-    print(f"\n{'='*50}")
-    print("APPLYING GROUPING LOGIC")
-    print(f"{'='*50}")
+    logger.info("\n%s\nAPPLYING GROUPING LOGIC\n%s", '='*50, '='*50)
     
-    df = pd.DataFrame(all_records)
+    df = compact_dataframe(pd.DataFrame(all_records))
     df_filtered = df.dropna(subset=['nota', 'empresa'])
     
-    print(f"Total records before filtering: {len(df)}")
-    print(f"Records with both nota and empresa: {len(df_filtered)}")
+    logger.info("Total records before filtering: %d", len(df))
+    logger.info("Records with both nota and empresa: %d", len(df_filtered))
     
     grouped_results = []
     
-    for (empresa, nota), group in df_filtered.groupby(['empresa', 'nota']):
-        print(f"\nProcessing group: Empresa='{empresa}', Nota='{nota}'")
-        print(f"  Records in group: {len(group)}")
-        
-        # Convert soma values to float safely
-        soma_values = [safe_float_conversion(val) for val in group['soma'].dropna().tolist()]
-        soma_notas_values = [safe_float_conversion(val) for val in group['soma_notas'].dropna().tolist()]
-        
-        if not soma_values:
-            print(f"  ⚠ No valid soma values found, skipping group")
-            continue
-        
-        print(f"  Soma values: {soma_values}")
-        print(f"  Soma_notas values: {soma_notas_values}")
-        
-        if len(group) == 1:
-            print(f"  ✓ Rule 1 applied: Single record, keeping as-is")
-            single_record = group.iloc[0]
-            soma_value = safe_float_conversion(single_record['soma'])
-            soma_notas_value = safe_float_conversion(soma_notas_values[0] if soma_notas_values else single_record['soma'])
-            
-            grouped_results.append({
-                'nota': nota,
-                'empresa': empresa,
-                'Valor': round(soma_value, 2),
-                'Valor_Total': round(soma_notas_value, 2),
-                'source': single_record.get('source', 'unknown'),
-                'sheet': single_record.get('sheet', 'unknown'),
-                'processing_rule': 'single_record'
-            })
-            continue
-        
-        soma_values_int = [int(val) for val in soma_values]
-        unique_soma_values = list(set(soma_values_int))
-        
-        if len(unique_soma_values) == 1:
-            unit_value_int = unique_soma_values[0]
-            
-            total_value = soma_notas_values[0] if soma_notas_values else sum(soma_values)
-            
-            if unit_value_int != 0:
-                num_rows = abs(total_value / unit_value_int)
-                print(f"  ✓ Rule 2 applied: Multiple records with all values equal (integer part only: {unit_value_int})")
-                print(f"  ✓ Total value: {total_value}, Unit value (int): {unit_value_int}")
-                print(f"  ✓ Number of rows to create: {num_rows}")
-                
-                original_unit_value = soma_values[0]
-                
-                for i in range(int(num_rows)):
-                    grouped_results.append({
-                        'nota': nota,
-                        'empresa': empresa,
-                        'Valor': round(original_unit_value, 2),
-                        'Valor_Total': round(total_value, 2),
-                        'source': group.iloc[0].get('source', 'unknown'),
-                        'sheet': group.iloc[0].get('sheet', 'unknown'),
-                        'processing_rule': 'equal_values_division'
-                    })
-            else:
-                print(f"  ⚠ Unit value is 0, skipping division")
-        else:
-            total_soma = sum(soma_values)
-            total_soma_notas = soma_notas_values[0] if soma_notas_values else total_soma
-            
-            print(f"  ✓ Rule 3 applied: Multiple records with different values")
-            print(f"  ✓ Total soma: {total_soma}")
-            print(f"  ✓ Total soma_notas: {total_soma_notas}")
-            
-            if abs(total_soma - total_soma_notas) < 0.01:
-                print(f"  ✓ Sum equals soma_nota, creating single row")
-                grouped_results.append({
-                    'nota': nota,
-                    'empresa': empresa,
-                    'Valor': round(total_soma, 2),
-                    'Valor_Total': round(total_soma_notas, 2),
-                    'source': group.iloc[0].get('source', 'unknown'),
-                    'sheet': group.iloc[0].get('sheet', 'unknown'),
-                    'processing_rule': 'different_values_sum'
-                })
+    groups_cache = None if cache is None else cache.get('groups', {})
+    used_groups = {}
+    reused = 0
+
+    grouped = df_filtered.groupby(['empresa', 'nota'], observed=True)
+
+    if cache is None:
+        for (empresa, nota), group in grouped:
+            grouped_results.extend(group_key_records(empresa, nota, group, max_expanded_rows))
+    else:
+        group_hashes = group_content_hashes(df_filtered, grouped)
+        for (empresa, nota), group in grouped:
+            key = group_hashes.get((empresa, nota))
+            if key is not None and key in groups_cache:
+                results = [dict(record) for record in groups_cache[key]]
+                reused += 1
             else:
-                print(f"  ⚠ Sum ({total_soma}) does not equal soma_nota ({total_soma_notas})")
-                grouped_results.append({
-                    'nota': nota,
-                    'empresa': empresa,
-                    'Valor': round(total_soma, 2),
-                    'Valor_Total': round(total_soma_notas, 2),
-                    'source': group.iloc[0].get('source', 'unknown'),
-                    'sheet': group.iloc[0].get('sheet', 'unknown'),
-                    'processing_rule': 'different_values_sum_discrepancy'
-                })
-    
-    print(f"\n✓ Initial grouping logic applied")
-    print(f"✓ Original records: {len(df_filtered)}")
-    print(f"✓ Grouped results: {len(grouped_results)}")
+                results = group_key_records(empresa, nota, group, max_expanded_rows)
+            if key is not None:
+                used_groups[key] = results
+            grouped_results.extend(results)
+
+    if cache is not None:
+        cache['groups'] = used_groups
+        logger.info("♻️  Grouping reused for %d of %d (empresa, nota) group(s)", reused, len(used_groups))
+
+    logger.info("\n✓ Initial grouping logic applied")
+    logger.info("✓ Original records: %d", len(df_filtered))
+    logger.info("✓ Grouped results: %d", len(grouped_results))
     
-    final_results = cancel_opposing_values(grouped_results)
+    final_results = cancel_opposing_values(grouped_results, cache=cache)
     
     return final_results
\ No newline at end of file
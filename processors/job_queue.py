@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from processors.stem_pipeline import discover_stem_files, process_stem
+from processors.grouping_logic import MAX_EXPANDED_ROWS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_DB = os.path.join("artifacts", "queue.sqlite3")
+DEFAULT_LEASE_SECONDS = 1800
+DEFAULT_MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stem_jobs (
+    stem TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    updated_at REAL
+)
+"""
+
+
+def connect_queue(db_path=DEFAULT_QUEUE_DB):
+    """
+    Open the queue database. SQLite file locking is what keeps workers from claiming the
+    same stem, so on a shared folder the file system must support it (SMB usually does,
+    some NFS setups do not).
+    """
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute(SCHEMA)
+    return conn
+
+
+def enqueue_stems(db_path=DEFAULT_QUEUE_DB, excel_folder="razoes", composicoes_folder="composicoes",
+                  requeue=False):
+    stems = sorted(discover_stem_files(excel_folder, composicoes_folder))
+    now = time.time()
+
+    conn = connect_queue(db_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for stem in stems:
+            conn.execute(
+                "INSERT OR IGNORE INTO stem_jobs (stem, status, updated_at) VALUES (?, 'pending', ?)",
+                (stem, now)
+            )
+            if requeue:
+                conn.execute(
+                    "UPDATE stem_jobs SET status = 'pending', lease_owner = NULL, lease_expires = NULL, "
+                    "attempts = 0, result = NULL, error = NULL, updated_at = ? WHERE stem = ?",
+                    (now, stem)
+                )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+    logger.info("📥 Queued %d stem(s) in '%s'", len(stems), db_path)
+    return stems
+
+
+def claim_next_stem(conn, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # A worker that died on the stem's last attempt never calls finish_stem
+        expired = conn.execute(
+            "UPDATE stem_jobs SET status = 'failed', lease_owner = NULL, lease_expires = NULL, "
+            "error = 'Lease expired on the last attempt', updated_at = ? "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (now, now, max_attempts)
+        ).rowcount
+        if expired:
+            logger.warning("⚠ Marked %d stem(s) as failed: their lease expired on the last attempt", expired)
+
+        row = conn.execute(
+            "SELECT stem FROM stem_jobs "
+            "WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ? "
+            "ORDER BY attempts, stem LIMIT 1",
+            (now, max_attempts)
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+
+        conn.execute(
+            "UPDATE stem_jobs SET status = 'leased', lease_owner = ?, lease_expires = ?, "
+            "attempts = attempts + 1, updated_at = ? WHERE stem = ?",
+            (worker_id, now + lease_seconds, now, row[0])
+        )
+        conn.execute("COMMIT")
+        return row[0]
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def renew_lease(conn, stem, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+    now = time.time()
+    cursor = conn.execute(
+        "UPDATE stem_jobs SET lease_expires = ?, updated_at = ? "
+        "WHERE stem = ? AND lease_owner = ? AND status = 'leased'",
+        (now + lease_seconds, now, stem, worker_id)
+    )
+    return cursor.rowcount == 1
+
+
+def finish_stem(conn, stem, worker_id, result=None, error=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    now = time.time()
+    if error is None:
+        status_sql = "'done'"
+    else:
+        # Failed stems go back to the queue until they run out of attempts
+        status_sql = "CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END"
+
+    params = [] if error is None else [max_attempts]
+    cursor = conn.execute(
+        f"UPDATE stem_jobs SET status = {status_sql}, lease_owner = NULL, lease_expires = NULL, "
+        "result = ?, error = ?, updated_at = ? WHERE stem = ? AND lease_owner = ?",
+        params + [json.dumps(result) if result is not None else None, error, now, stem, worker_id]
+    )
+    return cursor.rowcount == 1
+
+
+def default_worker_id(pid=None):
+    return f"{socket.gethostname()}:{pid or os.getpid()}"
+
+
+def finished_stem_results(db_path, worker_ids, since):
+    """
+    Results of the stems the given workers finished since the `since` timestamp, by stem.
+    Workers started as separate processes record nothing in the parent's run history, so
+    the parent reads their results back from the queue.
+    """
+    conn = connect_queue(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT stem, result FROM stem_jobs WHERE status = 'done' AND updated_at >= ?", (since,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    results = {stem: json.loads(result) for stem, result in rows if result}
+    return {stem: result for stem, result in results.items() if result.get("worker") in worker_ids}
+
+
+def queue_status(db_path=DEFAULT_QUEUE_DB):
+    conn = connect_queue(db_path)
+    try:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM stem_jobs GROUP BY status").fetchall())
+    finally:
+        conn.close()
+    return counts
+
+
+def _keep_lease_alive(db_path, stem, worker_id, lease_seconds, stop_event):
+    conn = connect_queue(db_path)
+    try:
+        while not stop_event.wait(lease_seconds / 3):
+            if not renew_lease(conn, stem, worker_id, lease_seconds):
+                logger.warning("⚠ Lost the lease on '%s'", stem)
+                return
+    finally:
+        conn.close()
+
+
+def run_worker(db_path=DEFAULT_QUEUE_DB, excel_folder="razoes", composicoes_folder="composicoes",
+               output_folder="output", worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+               max_attempts=DEFAULT_MAX_ATTEMPTS, memory_report=False,
+               expand_repeats=True, max_expanded_rows=MAX_EXPANDED_ROWS):
+    """
+    Claim stems from the queue until none are left. Any number of workers can share the
+    same queue database; a stem whose worker crashed is retried once its lease expires.
+    """
+    worker_id = worker_id or default_worker_id()
+    os.makedirs(output_folder, exist_ok=True)
+    conn = connect_queue(db_path)
+    processed = 0
+
+    try:
+        while True:
+            stem = claim_next_stem(conn, worker_id, lease_seconds, max_attempts)
+            if stem is None:
+                break
+
+            logger.info("🔒 %s claimed '%s'", worker_id, stem)
+            stop_event = threading.Event()
+            heartbeat = threading.Thread(
+                target=_keep_lease_alive, args=(db_path, stem, worker_id, lease_seconds, stop_event), daemon=True
+            )
+            heartbeat.start()
+            started = time.perf_counter()
+
+            try:
+                paths = discover_stem_files(excel_folder, composicoes_folder).get(stem)
+                if paths is None:
+                    raise FileNotFoundError(f"No input workbooks left for stem '{stem}'")
+                original_count, exported_rows, soma_notas_total = process_stem(
+                    stem, paths, output_folder, memory_report=memory_report,
+                    expand_repeats=expand_repeats, max_expanded_rows=max_expanded_rows, raise_errors=True
+                )
+            except Exception as e:
+                stop_event.set()
+                heartbeat.join()
+                logger.error("  ✗ %s failed on '%s': %s", worker_id, stem, e)
+                finish_stem(conn, stem, worker_id, error=str(e), max_attempts=max_attempts)
+                continue
+
+            stop_event.set()
+            heartbeat.join()
+            result = {
+                "original_records": original_count,
+                "grouped_records": exported_rows,
+                "soma_notas_total": round(soma_notas_total, 2),
+                "seconds": round(time.perf_counter() - started, 3),
+                "worker": worker_id
+            }
+            if finish_stem(conn, stem, worker_id, result=result):
+                processed += 1
+            else:
+                logger.warning("⚠ Result for '%s' discarded, the lease expired and was taken over", stem)
+    finally:
+        conn.close()
+
+    logger.info("✓ Worker %s finished: %d stem(s) processed", worker_id, processed)
+    return processed
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from processors.file_processor import parse_excel_lines, parse_single_composicoes_file
+from processors.excel_generator import create_stem_excel_file
+from processors.stem_pipeline import discover_stem_files
+from processors.grouping_logic import MAX_EXPANDED_ROWS
+from utils.artifacts import json_default
+from utils.run_history import add_stem_rows
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEDGER_DB = os.path.join("artifacts", "ledger.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ledger_runs (
+    run_id TEXT PRIMARY KEY,
+    started_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ledger_files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    file_hash TEXT NOT NULL,
+    stem TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    run_id TEXT NOT NULL REFERENCES ledger_runs(run_id),
+    ingested_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ledger_lines (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES ledger_files(file_id) ON DELETE CASCADE,
+    stem TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    sheet TEXT NOT NULL,
+    sheet_position INTEGER NOT NULL,
+    row_position INTEGER NOT NULL,
+    empresa TEXT,
+    nota TEXT,
+    soma REAL,
+    soma_notas REAL,
+    complemento TEXT,
+    record TEXT NOT NULL,
+    valid INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS idx_ledger_lines_empresa_nota ON ledger_lines (empresa COLLATE NOCASE, nota);
+CREATE INDEX IF NOT EXISTS idx_ledger_lines_stem ON ledger_lines (stem, kind, sheet_position, row_position);
+CREATE INDEX IF NOT EXISTS idx_ledger_lines_file ON ledger_lines (file_id);
+CREATE INDEX IF NOT EXISTS idx_ledger_files_hash ON ledger_files (file_hash);
+"""
+
+
+def connect_ledger(db_path=DEFAULT_LEDGER_DB):
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(SCHEMA)
+    # Ledgers created before every parsed line was stored only hold lines grouping keeps
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(ledger_lines)")}
+    if "valid" not in columns:
+        conn.execute("ALTER TABLE ledger_lines ADD COLUMN valid INTEGER NOT NULL DEFAULT 1")
+    return conn
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _optional_text(value):
+    return None if value is None else str(value)
+
+
+def _optional_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _ledger_rows(file_id, file_stem, kind, sheets):
+    for sheet_position, (sheet_name, records, valid_flags) in enumerate(sheets):
+        for row_position, (record, valid) in enumerate(zip(records, valid_flags)):
+            yield (
+                file_id, file_stem, kind, sheet_name, sheet_position, row_position,
+                _optional_text(record.get('empresa')),
+                _optional_text(record.get('nota')),
+                _optional_float(record.get('soma')),
+                _optional_float(record.get('soma_notas')),
+                _optional_text(record.get('Complemento')),
+                json.dumps(record, ensure_ascii=False, default=json_default),
+                int(valid)
+            )
+
+
+def store_file(conn, run_id, file_path, file_stem, kind, memory_report=False):
+    """
+    Parse one workbook into the ledger. A path whose content hash is already stored is skipped,
+    and a workbook that fails to parse is not stored, so the next run tries it again.
+    """
+    file_hash = hash_file(file_path)
+    path = str(file_path)
+
+    if conn.execute("SELECT 1 FROM ledger_files WHERE path = ? AND file_hash = ?", (path, file_hash)).fetchone():
+        logger.info("  ↺ Unchanged, already in ledger: %s", path)
+        return False
+
+    try:
+        if kind == "excel":
+            sheets = [(sheet_name, records, valid_flags)
+                      for sheet_name, (records, valid_flags) in parse_excel_lines(file_path, memory_report).items()]
+        else:
+            logger.info("Processing composicoes: %s", file_path.name)
+            records = parse_single_composicoes_file(file_path, file_stem)
+            sheets = [("Fornecedores", records, [True] * len(records))]
+    except Exception as e:
+        # No ledger_files row, so the next run parses the workbook again instead of skipping it
+        logger.error("  ✗ Error processing %s, not stored in ledger: %s", path, e)
+        return False
+
+    with conn:
+        # The workbook at this path changed: its previous content is replaced, not added to
+        conn.execute("DELETE FROM ledger_files WHERE path = ?", (path,))
+        file_id = conn.execute(
+            "INSERT INTO ledger_files (path, file_hash, stem, kind, run_id, ingested_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (path, file_hash, file_stem, kind, run_id, time.time())
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO ledger_lines (file_id, stem, kind, sheet, sheet_position, row_position, "
+            "empresa, nota, soma, soma_notas, complemento, record, valid) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            _ledger_rows(file_id, file_stem, kind, sheets)
+        )
+    add_stem_rows(file_stem, sum(sum(valid_flags) for _, _, valid_flags in sheets))
+    logger.info("  💾 Stored %s in ledger", path)
+    return True
+
+
+def ingest_folders_into_ledger(db_path=DEFAULT_LEDGER_DB, excel_folder="razoes", composicoes_folder="composicoes",
+                               memory_report=False):
+    conn = connect_ledger(db_path)
+    run_id = uuid.uuid4().hex
+    stored = 0
+
+    try:
+        with conn:
+            conn.execute("INSERT INTO ledger_runs (run_id, started_at) VALUES (?, ?)", (run_id, time.time()))
+
+        for file_stem, paths in sorted(discover_stem_files(excel_folder, composicoes_folder).items()):
+            for kind in ("excel", "composicoes"):
+                if paths[kind] is not None:
+                    stored += store_file(conn, run_id, paths[kind], file_stem, kind, memory_report=memory_report)
+    finally:
+        conn.close()
+
+    logger.info("✓ Ledger run %s: %d new or changed workbook(s)", run_id, stored)
+    return run_id, stored
+
+
+def load_stem_data(conn, file_stem):
+    """
+    Rebuild the excel_data / composicoes_data shape the grouping stage expects for one stem,
+    from the lines filter_valid_rows kept when they were stored.
+    """
+    excel_sheets = {}
+    composicoes_records = None
+
+    rows = conn.execute(
+        "SELECT kind, sheet, record FROM ledger_lines WHERE stem = ? AND valid = 1 "
+        "ORDER BY kind, file_id, sheet_position, row_position",
+        (file_stem,)
+    )
+    for kind, sheet, record in rows:
+        if kind == "excel":
+            excel_sheets.setdefault(sheet, []).append(json.loads(record))
+        else:
+            composicoes_records = composicoes_records or []
+            composicoes_records.append(json.loads(record))
+
+    stored_kinds = {kind for (kind,) in conn.execute("SELECT kind FROM ledger_files WHERE stem = ?", (file_stem,))}
+
+    excel_data = {}
+    if "excel" in stored_kinds:
+        excel_data[file_stem] = {
+            sheet: {
+                "records": records,
+                "soma_notas_total": round(sum(float(r['soma_notas']) for r in records if 'soma_notas' in r), 2)
+            }
+            for sheet, records in excel_sheets.items()
+        }
+
+    composicoes_data = {}
+    if "composicoes" in stored_kinds:
+        composicoes_data[file_stem] = composicoes_records or []
+
+    return excel_data, composicoes_data
+
+
+def group_from_ledger(db_path=DEFAULT_LEDGER_DB, output_folder="output",
+                      expand_repeats=True, max_expanded_rows=MAX_EXPANDED_ROWS):
+    os.makedirs(output_folder, exist_ok=True)
+    conn = connect_ledger(db_path)
+    total_grouped = 0
+
+    try:
+        stems = [stem for (stem,) in conn.execute("SELECT DISTINCT stem FROM ledger_files ORDER BY stem")]
+        logger.info("\n%s\nGROUPING %d STEM(S) FROM LEDGER\n%s", '='*50, len(stems), '='*50)
+
+        for file_stem in stems:
+            excel_data, composicoes_data = load_stem_data(conn, file_stem)
+            _, exported_rows = create_stem_excel_file(
+                file_stem, excel_data, composicoes_data, output_folder,
+                expand_repeats=expand_repeats, max_expanded_rows=max_expanded_rows
+            )
+            total_grouped += exported_rows
+    finally:
+        conn.close()
+
+    logger.info("\n📊 Total grouped records saved across all files: %d", total_grouped)
+    return total_grouped
+
+
+def query_ledger(db_path=DEFAULT_LEDGER_DB, empresa=None, nota=None):
+    conditions = []
+    params = []
+    if empresa is not None:
+        conditions.append("l.empresa = ? COLLATE NOCASE")
+        params.append(empresa)
+    if nota is not None:
+        conditions.append("l.nota = ?")
+        params.append(str(nota))
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    conn = connect_ledger(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT f.path, l.stem, l.kind, l.sheet, l.empresa, l.nota, l.soma, l.soma_notas, l.complemento, "
+            "l.valid, f.run_id "
+            f"FROM ledger_lines l JOIN ledger_files f ON f.file_id = l.file_id {where} "
+            "ORDER BY f.path, l.sheet_position, l.row_position",
+            params
+        ).fetchall()
+    finally:
+        conn.close()
+
+    columns = ["path", "stem", "kind", "sheet", "empresa", "nota", "soma", "soma_notas", "complemento", "valid",
+               "run_id"]
+    return [dict(zip(columns, row)) for row in rows]
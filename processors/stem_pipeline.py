@@ -0,0 +1,102 @@
+import logging
+import os
+from pathlib import Path
+from processors.file_processor import (
+    get_excel_files, process_single_excel_file, process_single_composicoes_file,
+    parse_single_excel_file, parse_single_composicoes_file
+)
+from processors.excel_generator import create_stem_excel_file
+from processors.grouping_logic import MAX_EXPANDED_ROWS
+
+logger = logging.getLogger(__name__)
+
+
+def discover_stem_files(excel_folder="razoes", composicoes_folder="composicoes"):
+    stems = {}
+
+    for ext in ['*.xlsx', '*.xls']:
+        for file_path in Path(excel_folder).glob(ext):
+            stems.setdefault(file_path.stem, {"excel": None, "composicoes": None})["excel"] = file_path
+
+    if os.path.exists(composicoes_folder):
+        for file in get_excel_files(composicoes_folder):
+            file_path = Path(composicoes_folder) / file
+            stems.setdefault(file_path.stem, {"excel": None, "composicoes": None})["composicoes"] = file_path
+
+    return stems
+
+
+def new_pipeline_summary():
+    return {
+        "total_files": 0,
+        "excel_files": 0,
+        "composicoes_files": 0,
+        "files_with_both_sources": 0,
+        "total_original_records": 0,
+        "total_grouped_records": 0,
+        "soma_notas_total": 0.0,
+        "grouping_applied": True
+    }
+
+
+def process_stem(file_stem, paths, output_folder="output", memory_report=False,
+                 expand_repeats=True, max_expanded_rows=MAX_EXPANDED_ROWS, group_cache=None, raise_errors=False):
+    """
+    Read, group and write one stem. With raise_errors a workbook that cannot be parsed raises
+    instead of being read as empty, so the queue can retry the stem or mark it failed.
+    """
+    read_excel = parse_single_excel_file if raise_errors else process_single_excel_file
+    read_composicoes = parse_single_composicoes_file if raise_errors else process_single_composicoes_file
+    excel_data = {}
+    composicoes_data = {}
+    soma_notas_total = 0.0
+
+    if paths["excel"] is not None:
+        file_data, soma_notas_total = read_excel(paths["excel"], memory_report=memory_report)
+        excel_data[file_stem] = file_data
+
+    if paths["composicoes"] is not None:
+        logger.info("Processing composicoes: %s", paths["composicoes"].name)
+        composicoes_data[file_stem] = read_composicoes(paths["composicoes"], file_stem)
+
+    original_count, exported_rows = create_stem_excel_file(
+        file_stem, excel_data, composicoes_data, output_folder,
+        expand_repeats=expand_repeats, max_expanded_rows=max_expanded_rows,
+        group_cache=group_cache
+    )
+    return original_count, exported_rows, soma_notas_total
+
+
+def run_stem_pipeline(excel_folder="razoes", composicoes_folder="composicoes", output_folder="output",
+                      memory_report=False, expand_repeats=True, max_expanded_rows=MAX_EXPANDED_ROWS,
+                      group_cache=None):
+    """
+    Process one file stem at a time: read its razão and composições, group and write it,
+    then drop it before loading the next, so peak memory is a single stem.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    stems = discover_stem_files(excel_folder, composicoes_folder)
+
+    logger.info("\n%s\nPROCESSING %d FILE STEM(S) ONE AT A TIME\n%s", '='*50, len(stems), '='*50)
+
+    summary = new_pipeline_summary()
+
+    for file_stem in sorted(stems):
+        paths = stems[file_stem]
+        original_count, exported_rows, soma_notas_total = process_stem(
+            file_stem, paths, output_folder, memory_report=memory_report,
+            expand_repeats=expand_repeats, max_expanded_rows=max_expanded_rows,
+            group_cache=group_cache
+        )
+
+        summary["total_files"] += 1
+        summary["excel_files"] += paths["excel"] is not None
+        summary["composicoes_files"] += paths["composicoes"] is not None
+        summary["files_with_both_sources"] += paths["excel"] is not None and paths["composicoes"] is not None
+        summary["total_original_records"] += original_count
+        summary["total_grouped_records"] += exported_rows
+        summary["soma_notas_total"] += soma_notas_total
+
+    logger.info("🔢 Excel folder total: R$ %s", f"{summary['soma_notas_total']:,.2f}")
+    logger.info("\n📊 Total grouped records saved across all files: %d", summary["total_grouped_records"])
+    return summary
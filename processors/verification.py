@@ -0,0 +1,241 @@
+import copy
+import json
+import logging
+import numbers
+import random
+import time
+from collections import defaultdict
+from processors.excel_generator import merge_file_records, expand_repeated_records, EXPORT_DROPPED_COLUMNS
+from processors.file_processor import process_excel_folder, process_composicoes_folder
+from processors.grouping_logic import apply_grouping_logic, deduplicate_grouped_records
+from processors.ledger_store import connect_ledger, load_stem_data, DEFAULT_LEDGER_DB
+from processors.reference_grouping import reference_stem_records
+from utils.artifacts import json_default
+
+logger = logging.getLogger(__name__)
+
+CENTS_TOLERANCE = 0.01
+NUMERIC_FIELDS = ('Valor', 'Valor_Total')
+PATHS = ("reference", "optimized", "optimized_cached")
+
+GENERATED_EMPRESAS = ["ACME", "ACME LTDA", "BETA S/A", "GAMA SERVICOS ME", "DELTA COMERCIO LTDA", "OMEGA S.A."]
+# Repeated unit values make rule 2 groups and opposing pairs; 1.9 and 2.5 give large row counts
+GENERATED_UNIT_VALUES = [1.9, 2.5, 33.3, 100.0, 250.5, 1000.0]
+
+
+def iter_folder_stems(excel_folder="razoes", composicoes_folder="composicoes"):
+    excel_data = process_excel_folder(excel_folder)
+    composicoes_data = process_composicoes_folder(composicoes_folder)
+    for file_stem in sorted(set(excel_data) | set(composicoes_data)):
+        file_records, _, _ = merge_file_records(file_stem, excel_data, composicoes_data)
+        yield file_stem, file_records
+
+
+def iter_ledger_stems(db_path=DEFAULT_LEDGER_DB):
+    conn = connect_ledger(db_path)
+    try:
+        stems = [stem for (stem,) in conn.execute("SELECT DISTINCT stem FROM ledger_files ORDER BY stem")]
+        for file_stem in stems:
+            excel_data, composicoes_data = load_stem_data(conn, file_stem)
+            file_records, _, _ = merge_file_records(file_stem, excel_data, composicoes_data)
+            yield file_stem, file_records
+    finally:
+        conn.close()
+
+
+def generated_value(rng):
+    value = rng.choice(GENERATED_UNIT_VALUES) if rng.random() < 0.6 else rng.uniform(1, 2000)
+    # Debits make cancellations and negative totals
+    return round(value if rng.random() < 0.7 else -value, 2)
+
+
+def generated_group_values(rng):
+    """
+    (soma of each line, whether the lines go to different notas) for one group of lines:
+    a single line, equal values (rule 2), different values, or an opposing pair to cancel.
+    """
+    roll = rng.random()
+    if roll < 0.4:
+        return [generated_value(rng)], False
+    if roll < 0.65:
+        unit = generated_value(rng)
+        # Same integer part, sometimes different cents
+        return [unit if rng.random() < 0.8 else round(unit + 0.01, 2) for _ in range(rng.randint(2, 5))], False
+    if roll < 0.9:
+        return [generated_value(rng) for _ in range(rng.randint(2, 4))], False
+    value = generated_value(rng)
+    return [value, -value], True
+
+
+def generate_stem_data(rng, rows, sheets=3):
+    """
+    Parsed razão sheets and composições records for one synthetic stem, in the shape
+    process_single_excel_file and process_single_composicoes_file return. Lines are made
+    group by group so every grouping rule, cancellation and deduplication case shows up.
+    """
+    notas = range(100, 100 + max(rows // 4, 10))
+    sheet_records = {f"M{index + 1}": [] for index in range(sheets)}
+
+    produced = 0
+    while produced < rows:
+        empresa = rng.choice(GENERATED_EMPRESAS)
+        sheet_name = rng.choice(list(sheet_records))
+        values, separate_notas = generated_group_values(rng)
+        nota = str(rng.choice(notas))
+        for soma in values:
+            if separate_notas:
+                nota = str(rng.choice(notas))
+            sheet_records[sheet_name].append({
+                "Complemento": f"NF <{nota}> - {empresa}",
+                "Débito": -soma if soma < 0 else 0.0,
+                "Crédito": soma if soma > 0 else 0.0,
+                "nota": nota,
+                "empresa": empresa,
+                "soma": soma,
+            })
+        produced += len(values)
+
+    file_data = {}
+    for sheet_name, records in sheet_records.items():
+        totals = defaultdict(float)
+        for record in records:
+            totals[(record["nota"], record["empresa"])] += record["soma"]
+        for record in records:
+            record["soma_notas"] = round(totals[(record["nota"], record["empresa"])], 2)
+            # Now and then the sheet total disagrees with the group, as in badly closed razões
+            if rng.random() < 0.05:
+                record["soma_notas"] = generated_value(rng)
+        file_data[sheet_name] = {
+            "records": records,
+            "soma_notas_total": round(sum(record["soma_notas"] for record in records), 2)
+        }
+
+    razao_records = [record for sheet_data in file_data.values() for record in sheet_data["records"]]
+    composicoes_records = []
+    for record in rng.sample(razao_records, min(len(razao_records), rows // 10)):
+        # Same nota and value as a razão line, sometimes under another spelling of the empresa
+        empresa = record["empresa"] if rng.random() < 0.7 else rng.choice(GENERATED_EMPRESAS)
+        composicoes_records.append({"nota": int(record["nota"]), "empresa": empresa, "soma": abs(record["soma"])})
+    composicoes_records.append({"nota": None, "empresa": rng.choice(GENERATED_EMPRESAS), "soma": 100.0})
+
+    return file_data, composicoes_records
+
+
+def iter_generated_stems(stems=3, rows=2000, seed=0):
+    rng = random.Random(seed)
+    for index in range(stems):
+        file_stem = f"generated{index + 1}"
+        file_data, composicoes_records = generate_stem_data(rng, rows)
+        file_records, _, _ = merge_file_records(file_stem, {file_stem: file_data}, {file_stem: composicoes_records})
+        yield file_stem, file_records
+
+
+def exported_fields(record):
+    return {key: value for key, value in record.items() if key not in EXPORT_DROPPED_COLUMNS}
+
+
+def reference_export_rows(file_records):
+    """Rows the original export wrote, from the frozen pre-optimization grouping."""
+    return [exported_fields(record) for record in reference_stem_records(file_records)]
+
+
+def optimized_export_rows(file_records, cache=None):
+    """Rows the current export writes, with every repeated record expanded and no cap."""
+    grouped_records = apply_grouping_logic(file_records, cache=cache)
+    grouped_records, _ = deduplicate_grouped_records(grouped_records)
+    rows, _ = expand_repeated_records([exported_fields(record) for record in grouped_records], None)
+    return rows
+
+
+def record_sort_key(record):
+    numbers_part = tuple(round(float(record.get(field) or 0), 2) for field in NUMERIC_FIELDS)
+    other_part = tuple(sorted((key, str(value)) for key, value in record.items() if key not in NUMERIC_FIELDS))
+    return other_part, numbers_part
+
+
+def values_match(reference_value, optimized_value, tolerance):
+    if isinstance(reference_value, numbers.Number) and isinstance(optimized_value, numbers.Number):
+        return abs(float(reference_value) - float(optimized_value)) <= tolerance + 1e-9
+    return reference_value == optimized_value
+
+
+def diff_records(reference_records, optimized_records, tolerance=CENTS_TOLERANCE):
+    """Pair the exported fields of both sides in a stable order and list every field that differs."""
+    reference_rows = sorted((exported_fields(r) for r in reference_records), key=record_sort_key)
+    optimized_rows = sorted((exported_fields(r) for r in optimized_records), key=record_sort_key)
+
+    differences = []
+    for position, (reference_row, optimized_row) in enumerate(zip(reference_rows, optimized_rows)):
+        for field in sorted(set(reference_row) | set(optimized_row)):
+            reference_value = reference_row.get(field)
+            optimized_value = optimized_row.get(field)
+            if not values_match(reference_value, optimized_value, tolerance):
+                differences.append({
+                    "position": position, "field": field,
+                    "reference": reference_value, "optimized": optimized_value
+                })
+
+    for position in range(len(optimized_rows), len(reference_rows)):
+        differences.append({"position": position, "field": None, "reference": reference_rows[position], "optimized": None})
+    for position in range(len(reference_rows), len(optimized_rows)):
+        differences.append({"position": position, "field": None, "reference": None, "optimized": optimized_rows[position]})
+
+    return differences
+
+
+def verify_stems(stems, tolerance=CENTS_TOLERANCE):
+    """
+    Run the frozen reference grouping and the current one on every (stem, records) pair and
+    diff the exported rows, with the current path's repeated records expanded. The current
+    path runs once without the group cache and once replaying a cache filled by an untimed
+    run, round-tripped through JSON as it would be from artifacts/group_cache.json.
+    """
+    summary = {
+        "stems": 0,
+        "records": {path: 0 for path in PATHS},
+        "seconds": {path: 0.0 for path in PATHS},
+        "differences": {},
+    }
+
+    # The grouping banners would print three times per stem
+    grouping_logger = logging.getLogger("processors.grouping_logic")
+    previous_level = grouping_logger.level
+    grouping_logger.setLevel(logging.WARNING)
+
+    try:
+        for file_stem, file_records in stems:
+            results = {}
+            cache = {}
+
+            inputs = copy.deepcopy(file_records)
+            started = time.perf_counter()
+            results["reference"] = reference_export_rows(inputs)
+            summary["seconds"]["reference"] += time.perf_counter() - started
+
+            inputs = copy.deepcopy(file_records)
+            started = time.perf_counter()
+            results["optimized"] = optimized_export_rows(inputs)
+            summary["seconds"]["optimized"] += time.perf_counter() - started
+
+            optimized_export_rows(copy.deepcopy(file_records), cache=cache)
+            cache = json.loads(json.dumps(cache, default=json_default))
+            inputs = copy.deepcopy(file_records)
+            started = time.perf_counter()
+            results["optimized_cached"] = optimized_export_rows(inputs, cache=cache)
+            summary["seconds"]["optimized_cached"] += time.perf_counter() - started
+
+            summary["stems"] += 1
+            for path in PATHS:
+                summary["records"][path] += len(results[path])
+
+            for path in PATHS[1:]:
+                differences = diff_records(results["reference"], results[path], tolerance)
+                if differences:
+                    summary["differences"].setdefault(file_stem, {})[path] = differences
+
+            status = "❌" if file_stem in summary["differences"] else "✅"
+            logger.info("%s %s: %d reference row(s)", status, file_stem, len(results["reference"]))
+    finally:
+        grouping_logger.setLevel(previous_level)
+
+    return summary
@@ -0,0 +1,153 @@
+import logging
+import os
+import time
+from processors.file_processor import process_single_excel_file, process_single_composicoes_file
+from processors.excel_generator import create_stem_excel_file
+from processors.stem_pipeline import discover_stem_files
+from processors.grouping_logic import MAX_EXPANDED_ROWS
+
+logger = logging.getLogger(__name__)
+
+
+def file_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def scan_stem_files(excel_folder, composicoes_folder):
+    files = {}
+    for file_stem, paths in discover_stem_files(excel_folder, composicoes_folder).items():
+        for kind, file_path in paths.items():
+            # Skip Excel lock files left next to workbooks that are open
+            if file_path is None or file_path.name.startswith('~$'):
+                continue
+            signature = file_signature(file_path)
+            if signature is not None:
+                files[file_path] = (kind, file_stem, signature)
+    return files
+
+
+def parse_stem_file(kind, file_path, file_stem, memory_report=False):
+    if kind == "excel":
+        file_data, _ = process_single_excel_file(file_path, memory_report=memory_report)
+        return file_data
+    logger.info("Processing composicoes: %s", file_path.name)
+    return process_single_composicoes_file(file_path, file_stem)
+
+
+def write_stem_from_cache(file_stem, parsed_cache, output_folder, expand_repeats, max_expanded_rows,
+                          group_cache=None):
+    excel_data = {}
+    composicoes_data = {}
+    for (kind, stem, _), data in parsed_cache.values():
+        if stem != file_stem:
+            continue
+        if kind == "excel":
+            excel_data[file_stem] = data
+        else:
+            composicoes_data[file_stem] = data
+
+    if not excel_data and not composicoes_data:
+        logger.info("🗑️  No inputs left for '%s', nothing to write", file_stem)
+        if group_cache is not None:
+            group_cache.pop(file_stem, None)
+        return
+
+    razao_sheets = excel_data.get(file_stem, {})
+    if not any(sheet_data.get('records') for sheet_data in razao_sheets.values()):
+        # Composições often land before their razão, and a razão that failed to parse is {}
+        logger.info("⏳ No razão records for '%s' yet, waiting before grouping it", file_stem)
+        return
+
+    create_stem_excel_file(
+        file_stem, excel_data, composicoes_data, output_folder,
+        expand_repeats=expand_repeats, max_expanded_rows=max_expanded_rows,
+        group_cache=group_cache
+    )
+
+
+def watch_folders(excel_folder="razoes", composicoes_folder="composicoes", output_folder="output",
+                  poll_interval=2.0, settle_seconds=5.0, max_polls=None, memory_report=False,
+                  expand_repeats=True, max_expanded_rows=MAX_EXPANDED_ROWS, use_group_cache=True):
+    """
+    Poll the input folders and regroup only the stems whose workbooks were added, modified
+    or removed. Parsed workbooks stay in memory between batches, and a file is only read
+    once its size and mtime have been stable for settle_seconds (partially written files).
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    # path -> ((kind, stem, signature), parsed data) for every workbook already read
+    parsed_cache = {}
+    # path -> (signature, first time that signature was seen)
+    pending = {}
+    # stem -> grouping/cancellation results keyed by content hash, so an edited workbook
+    # only regroups the (empresa, nota) groups that actually changed
+    group_cache = {} if use_group_cache else None
+
+    logger.info("\n%s\nWATCHING '%s' AND '%s'\n%s", '='*50, excel_folder, composicoes_folder, '='*50)
+
+    try:
+        poll_folders(excel_folder, composicoes_folder, output_folder, parsed_cache, pending,
+                     poll_interval, settle_seconds, max_polls, memory_report,
+                     expand_repeats, max_expanded_rows, group_cache)
+    except KeyboardInterrupt:
+        logger.info("\n🛑 Watch mode stopped")
+
+
+def poll_folders(excel_folder, composicoes_folder, output_folder, parsed_cache, pending,
+                 poll_interval, settle_seconds, max_polls, memory_report,
+                 expand_repeats, max_expanded_rows, group_cache=None):
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        if polls:
+            time.sleep(poll_interval)
+        polls += 1
+
+        now = time.monotonic()
+        current = scan_stem_files(excel_folder, composicoes_folder)
+        affected_stems = set()
+
+        for file_path in list(parsed_cache):
+            if file_path not in current:
+                (_, file_stem, _), _ = parsed_cache.pop(file_path)
+                logger.info("➖ Removed: %s", file_path)
+                affected_stems.add(file_stem)
+
+        for file_path in list(pending):
+            if file_path not in current:
+                del pending[file_path]
+
+        for file_path, (kind, file_stem, signature) in current.items():
+            cached = parsed_cache.get(file_path)
+            if cached is not None and cached[0][2] == signature:
+                pending.pop(file_path, None)
+                continue
+
+            first_seen = pending.get(file_path)
+            if first_seen is None or first_seen[0] != signature:
+                pending[file_path] = (signature, now)
+                # The first scan has nothing in flight to wait for
+                if polls > 1:
+                    continue
+            elif now - first_seen[1] < settle_seconds:
+                continue
+
+            logger.info("➕ %s: %s", "Changed" if cached else "New", file_path)
+            data = parse_stem_file(kind, file_path, file_stem, memory_report=memory_report)
+            parsed_cache[file_path] = ((kind, file_stem, signature), data)
+            del pending[file_path]
+            affected_stems.add(file_stem)
+
+        for file_stem in sorted(affected_stems):
+            try:
+                write_stem_from_cache(file_stem, parsed_cache, output_folder, expand_repeats, max_expanded_rows,
+                                      group_cache)
+            except Exception as e:
+                # One bad stem must not stop the watcher; it is retried when its files change again
+                logger.error("  ✗ Error regrouping '%s': %s", file_stem, e)
+
+        if affected_stems:
+            logger.info("👀 Reprocessed %d stem(s); waiting for new workbooks", len(affected_stems))
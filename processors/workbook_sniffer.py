@@ -0,0 +1,59 @@
+import logging
+from pathlib import Path
+import pandas as pd
+from openpyxl import load_workbook
+
+logger = logging.getLogger(__name__)
+
+# How many rows at the top of a sheet are scanned for the header
+SNIFF_ROWS = 30
+SNIFFABLE_SUFFIXES = ('.xlsx', '.xlsm')
+
+
+def open_workbook(file_path):
+    """Read-only workbook shared by the sniffer and pandas, or None for formats openpyxl cannot read (.xls)."""
+    if Path(file_path).suffix.lower() not in SNIFFABLE_SUFFIXES:
+        return None
+    return load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+
+
+def find_header_row(rows, header_columns):
+    for row_index, row in enumerate(rows):
+        values = {str(value).strip() for value in row if value is not None}
+        if all(column in values for column in header_columns):
+            return row_index
+    return None
+
+
+def sniff_workbook(workbook, header_columns, sheet_names=None, max_rows=SNIFF_ROWS):
+    """
+    Look at the first rows of each sheet without loading it: returns, in sheet order,
+    {sheet_name: {"header_row", "max_row", "max_column"}}. header_row is the 0-based row
+    holding every one of header_columns (the skiprows to pass to pandas), or None.
+    """
+    sheets = {}
+
+    for worksheet in workbook.worksheets:
+        if sheet_names is not None and worksheet.title not in sheet_names:
+            continue
+
+        # Dimensions as declared by the file; they can be stale, so rows are read with them reset
+        max_row, max_column = worksheet.max_row, worksheet.max_column
+        worksheet.reset_dimensions()
+        header_row = find_header_row(worksheet.iter_rows(max_row=max_rows, values_only=True), header_columns)
+
+        sheets[worksheet.title] = {"header_row": header_row, "max_row": max_row, "max_column": max_column}
+        logger.debug("  Sniffed sheet '%s': %s rows x %s columns, header row %s",
+                     worksheet.title, max_row, max_column, header_row)
+
+    return sheets
+
+
+def read_sniffed_sheets(workbook, sniffed):
+    """Read every sniffed sheet that has a header row, starting at that row."""
+    with pd.ExcelFile(workbook, engine="openpyxl") as excel_file:
+        return {
+            sheet_name: excel_file.parse(sheet_name, skiprows=info["header_row"])
+            for sheet_name, info in sniffed.items()
+            if info["header_row"] is not None
+        }
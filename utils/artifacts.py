@@ -0,0 +1,23 @@
+import json
+import os
+from utils.data_utils import convert_to_json_serializable
+
+
+def json_default(obj):
+    value = convert_to_json_serializable(obj)
+    return str(value) if value is obj else value
+
+
+def save_artifact(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False, default=json_default)
+    os.replace(tmp_path, path)
+
+
+def load_artifact(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Artifact '{path}' not found, run the previous stage first")
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
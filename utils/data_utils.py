@@ -1,20 +1,11 @@
+import logging
 import pandas as pd
 import json
-import math
+import sys
 import numpy as np
 from datetime import datetime, date
 
-
-def has_nan_values(obj):
-    if isinstance(obj, dict):
-        return any(has_nan_values(value) for value in obj.values())
-    elif isinstance(obj, list):
-        return any(has_nan_values(item) for item in obj)
-    elif isinstance(obj, float) and math.isnan(obj):
-        return True
-    elif pd.isna(obj):
-        return True
-    return False
+logger = logging.getLogger(__name__)
 
 
 def convert_to_json_serializable(obj):
@@ -34,16 +25,96 @@ def convert_to_json_serializable(obj):
         return obj
 
 
+def _is_text_dtype(dtype):
+    return dtype == 'object' or isinstance(dtype, pd.StringDtype)
+
+
+def _coerce_object_column(series):
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind in ('string', 'empty'):
+        return series
+    if kind == 'datetime':
+        return pd.to_datetime(series).dt.strftime('%Y-%m-%dT%H:%M:%S').astype(object)
+    if kind == 'date':
+        return pd.to_datetime(series).dt.strftime('%Y-%m-%d').astype(object)
+    if kind in ('integer', 'floating', 'boolean', 'mixed-integer-float', 'decimal'):
+        # numpy scalars are unboxed by to_dict, nothing to do per cell
+        return series
+    return series.map(convert_to_json_serializable)
+
+
+def coerce_json_types(df, strip_strings=False):
+    for col in df.columns:
+        series = df[col]
+
+        if pd.api.types.is_datetime64_any_dtype(series.dtype):
+            series = series.dt.strftime('%Y-%m-%d %H:%M:%S').astype(object)
+        elif _is_text_dtype(series.dtype):
+            series = _coerce_object_column(series)
+        else:
+            continue
+
+        missing = series.isna()
+        if strip_strings:
+            # Missing text becomes 'None', as the former astype(str) pass produced
+            df[col] = series.astype(str).str.strip().astype(object).where(~missing, 'None')
+        else:
+            df[col] = series.astype(object).where(~missing, None)
+
+    return df
+
+
 def prepare_dataframe_for_json(df):
-    df_copy = df.copy()
+    return coerce_json_types(df.copy())
+
+
+COMPACT_CATEGORY_COLUMNS = ['empresa', 'source', 'sheet']
+# Only read to extract nota and empresa; every record used to keep a list of strings for it
+PARSED_FRAGMENTS_COLUMN = 'ComplementoParsed'
+
 
-    for col in df_copy.columns:
-        if df_copy[col].dtype == 'datetime64[ns]':
-            df_copy[col] = df_copy[col].dt.strftime('%Y-%m-%d %H:%M:%S')
-        elif df_copy[col].dtype == 'object':
-            df_copy[col] = df_copy[col].apply(convert_to_json_serializable)
+def compact_dataframe(df, category_columns=COMPACT_CATEGORY_COLUMNS):
+    if PARSED_FRAGMENTS_COLUMN in df.columns:
+        df = df.drop(columns=[PARSED_FRAGMENTS_COLUMN])
 
-    return df_copy.where(pd.notnull(df_copy), None)
+    for col in category_columns:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+
+    return df
+
+
+def _deep_size(value, seen):
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(_deep_size(item, seen) for item in value)
+    return size
+
+
+def records_bytes_per_row(records):
+    """
+    Bytes held by a list of record dicts, per record. Values shared between records
+    (the same category string, small ints) are counted once; keys are not counted.
+    """
+    if not records:
+        return 0.0
+
+    seen = set()
+    total = sys.getsizeof(records)
+    for record in records:
+        total += sys.getsizeof(record) + sum(_deep_size(value, seen) for value in record.values())
+    return total / len(records)
+
+
+def log_memory_report(label, bytes_before, bytes_after):
+    change = bytes_after - bytes_before
+    ratio = (abs(change) / bytes_before * 100) if bytes_before else 0.0
+    logger.info("  🧮 Memory %s: %s → %s bytes/record (%.1f%% %s)",
+                label, f"{bytes_before:,.0f}", f"{bytes_after:,.0f}", ratio,
+                "larger" if change > 0 else "smaller")
 
 
 def normalize_nota_field(record):
@@ -59,15 +130,15 @@ def normalize_nota_field(record):
     return record
 
 
-def clean_nan_from_records(records):
-    cleaned_records = []
-    for record in records:
-        if has_nan_values(record):
-            continue
-        if 'soma_notas' in record and float(record['soma_notas']) == 0.0:
-            continue
-        cleaned_records.append(record)
-    return cleaned_records
+def valid_rows_mask(df):
+    mask = df.notna().all(axis=1)
+    if 'soma_notas' in df.columns:
+        mask &= pd.to_numeric(df['soma_notas'], errors='coerce') != 0.0
+    return mask
+
+
+def filter_valid_rows(df):
+    return df[valid_rows_mask(df)]
 
 
 # def get_valor_empreendimento_total():
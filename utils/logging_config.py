@@ -0,0 +1,11 @@
+import logging
+import os
+import sys
+
+LOG_FORMAT = '%(message)s'
+
+
+def configure_logging(level=None):
+    """Send log records to stdout as plain messages; LOG_LEVEL=DEBUG restores per-row and per-group detail"""
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+    logging.basicConfig(level=level, format=LOG_FORMAT, stream=sys.stdout)
@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Counters stay off by default so the extractors only pay for one flag check per call
+_enabled = False
+_counters = {}
+_samples = []
+_sample_limit = 0
+
+
+def enable_pattern_stats(sample_limit=5000):
+    global _enabled, _sample_limit
+    _enabled = True
+    _sample_limit = sample_limit
+
+
+def pattern_stats_enabled():
+    return _enabled
+
+
+def reset_pattern_stats():
+    _counters.clear()
+    _samples.clear()
+
+
+def record_pattern(name, hit, seconds=0.0, attempted=True):
+    counter = _counters.setdefault(name, {"attempts": 0, "hits": 0, "seconds": 0.0})
+    counter["attempts"] += attempted
+    counter["hits"] += bool(hit)
+    counter["seconds"] += seconds
+
+
+def run_pattern(name, pattern_func, text):
+    if not _enabled:
+        return pattern_func(text)
+    started = time.perf_counter()
+    result = pattern_func(text)
+    record_pattern(name, result, time.perf_counter() - started)
+    return result
+
+
+def record_sample(value):
+    if _enabled and len(_samples) < _sample_limit:
+        _samples.append(value)
+
+
+def drain_pattern_stats():
+    """
+    Counters and samples recorded in this process, cleared so they are not handed over
+    twice. Worker processes return this with their results for merge_pattern_stats.
+    """
+    if not _enabled:
+        return None
+    state = {"counters": dict(_counters), "samples": list(_samples)}
+    reset_pattern_stats()
+    return state
+
+
+def merge_pattern_stats(state):
+    if not state:
+        return
+    for name, worker_counter in state["counters"].items():
+        counter = _counters.setdefault(name, {"attempts": 0, "hits": 0, "seconds": 0.0})
+        for field in counter:
+            counter[field] += worker_counter[field]
+    room = max(_sample_limit - len(_samples), 0)
+    _samples.extend(state["samples"][:room])
+
+
+def pattern_samples():
+    return list(_samples)
+
+
+def pattern_stats_snapshot():
+    return {
+        name: {
+            **counter,
+            "hit_rate": round(counter["hits"] / counter["attempts"], 4) if counter["attempts"] else None
+        }
+        for name, counter in sorted(_counters.items())
+    }
+
+
+def save_pattern_stats(path, extra=None):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"patterns": pattern_stats_snapshot(), **(extra or {})}, file, ensure_ascii=False, indent=2)
+
+
+def load_pattern_stats(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def log_pattern_stats():
+    logger.info("\n%-60s %10s %10s %9s %10s", "PATTERN", "ATTEMPTS", "HITS", "HIT RATE", "SECONDS")
+    for name, counter in pattern_stats_snapshot().items():
+        hit_rate = f"{counter['hit_rate']:.1%}" if counter["hit_rate"] is not None else "-"
+        logger.info("%-60s %10d %10d %9s %10.4f",
+                    name[:60], counter["attempts"], counter["hits"], hit_rate, counter["seconds"])
@@ -1,4 +1,8 @@
 import re
+from utils.pattern_stats import (
+    run_pattern, record_pattern, record_sample, pattern_stats_enabled,
+    pattern_stats_snapshot, pattern_samples, save_pattern_stats, load_pattern_stats
+)
 
 
 def extract_nf_bracket_pattern(text):
@@ -52,32 +56,135 @@ def extract_first_number_with_keywords(text):
     return None
 
 
-def extract_nota_from_parsed(complemento_parsed):
+NOTA_PATTERNS = [
+    ("nota:nf_bracket", extract_nf_bracket_pattern),
+    ("nota:date_number", extract_date_number_pattern),
+    ("nota:nfes", extract_nfes_pattern),
+    ("nota:nf_ref", extract_nf_ref_pattern),
+    ("nota:nfeletr", extract_nfeletr_pattern),
+    ("nota:apolice", extract_apolice_pattern),
+    ("nota:first_number_with_keywords", extract_first_number_with_keywords)
+]
+# Matches almost anything the others match, so it always stays last
+FALLBACK_NOTA_PATTERN = "nota:first_number_with_keywords"
+# Can match alongside any keyword pattern, so they keep their fixed place ahead of them
+PINNED_NOTA_PATTERNS = ["nota:nf_bracket", "nota:date_number"]
+# Each of these only matches a fragment containing its literal. On a fragment with a single
+# literal at most one of them can match, so their relative order cannot change the result.
+KEYWORD_NOTA_PATTERNS = {
+    "nota:nfes": "NFES",
+    "nota:nf_ref": "NF_REF",
+    "nota:nfeletr": "NFELETR",
+    "nota:apolice": "APÓLICE",
+}
+
+_nota_patterns = list(NOTA_PATTERNS)
+
+
+def _run_uninstrumented(name, pattern_func, text):
+    return pattern_func(text)
+
+
+def has_several_keyword_literals(text):
+    upper_text = text.upper()
+    return sum(literal in upper_text for literal in KEYWORD_NOTA_PATTERNS.values()) > 1
+
+
+def extract_nota_with_order(complemento_parsed, patterns, run=run_pattern):
     if not isinstance(complemento_parsed, list):
         return None
 
     full_text = ' '.join(str(item) for item in complemento_parsed if isinstance(item, str))
-    nf_bracket_result = extract_nf_bracket_pattern(full_text)
+    nf_bracket_result = run("nota:nf_bracket_full_text", extract_nf_bracket_pattern, full_text)
     if nf_bracket_result:
         return nf_bracket_result
 
+    reordered = patterns != NOTA_PATTERNS
+
     for item in complemento_parsed:
         if not isinstance(item, str):
             continue
 
-        patterns = [
-            extract_nf_bracket_pattern,
-            extract_date_number_pattern,
-            extract_nfes_pattern,
-            extract_nf_ref_pattern,
-            extract_nfeletr_pattern,
-            extract_apolice_pattern,
-            extract_first_number_with_keywords
-        ]
-
-        for pattern_func in patterns:
-            result = pattern_func(item)
+        item_patterns = patterns
+        if reordered and has_several_keyword_literals(item):
+            item_patterns = NOTA_PATTERNS
+
+        for name, pattern_func in item_patterns:
+            result = run(name, pattern_func, item)
             if result:
                 return result
 
-    return None
\ No newline at end of file
+    return None
+
+
+def extract_nota_from_parsed(complemento_parsed):
+    result = extract_nota_with_order(complemento_parsed, _nota_patterns)
+    if pattern_stats_enabled() and isinstance(complemento_parsed, list):
+        record_sample(complemento_parsed)
+        record_pattern("nota:no_match", result is None)
+    return result
+
+
+def get_nota_pattern_order():
+    return [name for name, _ in _nota_patterns]
+
+
+def set_nota_pattern_order(names):
+    patterns_by_name = dict(NOTA_PATTERNS)
+    if (sorted(names) != sorted(patterns_by_name) or names[-1] != FALLBACK_NOTA_PATTERN
+            or names[:len(PINNED_NOTA_PATTERNS)] != PINNED_NOTA_PATTERNS):
+        raise ValueError(f"Invalid nota pattern order: {names}")
+    _nota_patterns[:] = [(name, patterns_by_name[name]) for name in names]
+
+
+def reset_nota_pattern_order():
+    _nota_patterns[:] = NOTA_PATTERNS
+
+
+def adaptive_nota_pattern_order(stats):
+    """
+    Keyword patterns sorted by hits, between the pinned patterns and the fallback. Fragments
+    holding more than one keyword literal are still tried in the fixed order, so the result
+    is the same as the fixed order for every input, not just the sampled ones.
+    """
+    fixed_index = {name: i for i, (name, _) in enumerate(NOTA_PATTERNS)}
+    hits = {name: stats.get(name, {}).get("hits", 0) for name in KEYWORD_NOTA_PATTERNS}
+    keyword_order = sorted(KEYWORD_NOTA_PATTERNS, key=lambda name: (-hits[name], fixed_index[name]))
+    return PINNED_NOTA_PATTERNS + keyword_order + [FALLBACK_NOTA_PATTERN]
+
+
+def verify_nota_pattern_order(names, samples):
+    """Return the sampled fragments for which the given order extracts a different nota than the fixed order"""
+    patterns_by_name = dict(NOTA_PATTERNS)
+    candidate = [(name, patterns_by_name[name]) for name in names]
+    return [
+        parsed for parsed in samples
+        if extract_nota_with_order(parsed, NOTA_PATTERNS, _run_uninstrumented)
+        != extract_nota_with_order(parsed, candidate, _run_uninstrumented)
+    ]
+
+
+def save_nota_pattern_stats(path):
+    """Export this run's counters with the adaptive order, re-checked against the fixed one on the sampled fragments"""
+    samples = pattern_samples()
+    order = adaptive_nota_pattern_order(pattern_stats_snapshot())
+    mismatches = verify_nota_pattern_order(order, samples)
+    save_pattern_stats(path, {
+        "active_nota_order": get_nota_pattern_order(),
+        "adaptive_nota_order": order,
+        "equivalence_samples": len(samples),
+        "equivalence_mismatches": len(mismatches)
+    })
+    return order, mismatches
+
+
+def apply_adaptive_nota_order(path):
+    data = load_pattern_stats(path)
+    if not data or not data.get("equivalence_samples") or data.get("equivalence_mismatches") != 0:
+        return False
+    try:
+        set_nota_pattern_order(data["adaptive_nota_order"])
+    except ValueError:
+        # Written by an older version that could move the pinned patterns
+        return False
+    return True
@@ -0,0 +1,145 @@
+import json
+import os
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_BASELINE_RUNS = 5
+DEFAULT_REGRESSION_THRESHOLD = 0.25
+
+# The run being recorded in this process, or None when history is off
+_run = None
+
+
+def start_run(stage):
+    global _run
+    _run = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "stage": stage,
+        "stages": {},
+        "rows": {},
+        "upload": None,
+    }
+    return _run
+
+
+@contextmanager
+def timed_stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _run is not None:
+            _run["stages"][name] = round(_run["stages"].get(name, 0.0) + time.perf_counter() - started, 4)
+
+
+def record_stem_rows(file_stem, rows):
+    if _run is not None:
+        _run["rows"][file_stem] = rows
+
+
+def add_stem_rows(file_stem, rows):
+    """Ingest counts razão and composições records separately, so they add up per stem."""
+    if _run is not None:
+        _run["rows"][file_stem] = _run["rows"].get(file_stem, 0) + rows
+
+
+def record_upload(upload_results):
+    if _run is None:
+        return
+    uploads = upload_results.get("successful_uploads", [])
+    _run["upload"] = {
+        "files": len(uploads),
+        "failed": len(upload_results.get("failed_uploads", [])),
+        "bytes": sum(upload.get("size", 0) for upload in uploads),
+        "seconds": round(sum(upload.get("seconds", 0.0) for upload in uploads), 4),
+    }
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def finish_run(path, seconds):
+    global _run
+    if _run is None:
+        return None
+
+    record = {
+        **_run,
+        "total_rows": sum(_run["rows"].values()),
+        "seconds": round(seconds, 4),
+        "peak_memory_mb": peak_memory_mb(),
+    }
+    _run = None
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return record
+
+
+def load_run_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def run_metrics(run):
+    """Comparable numbers for one run: stage seconds per 1000 input rows, upload seconds per MB, peak memory."""
+    rows = run.get("total_rows") or 0
+    per_rows = (lambda seconds: seconds * 1000 / rows) if rows else (lambda seconds: seconds)
+    unit = "s/1k rows" if rows else "s"
+
+    metrics = {f"stage:{name}": (per_rows(seconds), unit) for name, seconds in run.get("stages", {}).items()}
+    metrics["total"] = (per_rows(run.get("seconds", 0.0)), unit)
+
+    upload = run.get("upload")
+    if upload and upload.get("bytes"):
+        metrics["upload"] = (upload["seconds"] / (upload["bytes"] / (1024 * 1024)), "s/MB")
+    if run.get("peak_memory_mb") is not None:
+        metrics["peak_memory"] = (run["peak_memory_mb"], "MB")
+    return metrics
+
+
+def compare_with_baseline(history, baseline_runs=DEFAULT_BASELINE_RUNS, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """
+    Compare the latest run with the median of the previous baseline_runs runs of the same stage.
+    Returns (latest run, [{"metric", "unit", "latest", "baseline", "ratio", "regressed"}]).
+    """
+    if not history:
+        return None, []
+
+    latest = history[-1]
+    previous = [run for run in history[:-1] if run.get("stage") == latest.get("stage")][-baseline_runs:]
+    previous_metrics = [run_metrics(run) for run in previous]
+
+    report = []
+    for metric, (value, unit) in run_metrics(latest).items():
+        # Runs with and without row counts are not comparable, so only matching units count
+        baseline_values = [metrics[metric][0] for metrics in previous_metrics
+                           if metric in metrics and metrics[metric][1] == unit]
+        baseline = statistics.median(baseline_values) if baseline_values else None
+        ratio = value / baseline if baseline else None
+        report.append({
+            "metric": metric,
+            "unit": unit,
+            "latest": value,
+            "baseline": baseline,
+            "ratio": ratio,
+            "regressed": ratio is not None and ratio > 1 + threshold,
+        })
+
+    return latest, report
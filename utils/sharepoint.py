@@ -1,4 +1,5 @@
 import os
+import time
 import requests
 from pathlib import Path
 from dotenv import load_dotenv
@@ -97,13 +98,16 @@ def upload_excel_files_to_sharepoint(output_folder_path="./output"):
                 'Content-Type': 'application/octet-stream'
             }
             
+            started = time.perf_counter()
             response = requests.put(upload_url, headers=upload_headers, data=file_content)
+            upload_seconds = time.perf_counter() - started
             
             if response.status_code in [200, 201]:
                 print(f"✓ Successfully uploaded: {file_path.name}")
                 results["successful_uploads"].append({
                     "filename": file_path.name,
                     "size": len(file_content),
+                    "seconds": round(upload_seconds, 3),
                     "status": "success"
                 })
             else: